@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 from pathlib import Path
 import django_heroku
 import os
+import sys
 import dj_database_url
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -69,6 +70,8 @@ MIDDLEWARE = [
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "mainapp.middleware.StudentMiddleware",
+    "mainapp.middleware.CurrentClassMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -98,6 +101,7 @@ TEMPLATES = [
                 "mainapp.context_processors.is_assigned_professor",
                 "mainapp.context_processors.is_my_class",
                 "mainapp.context_processors.get_name",
+                "mainapp.context_processors.get_student_css",
             ],
         },
     },
@@ -202,6 +206,61 @@ LOGOUT_REDIRECT_URL = "/"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# when disabled, calendar reads go straight to google, with date filters sent as timeMin/timeMax
+EVENT_MIRROR_ENABLED = True
+# how old (in seconds) the local mirror of a google calendar may be before a read syncs it again
+# see mainapp/event_mirror.py
+EVENT_MIRROR_MAX_AGE = 60
+# number of events requested per page from google (at most 2500), and read per chunk from the mirror
+EVENT_PAGE_SIZE = 250
+# how stale calendars are fetched from google: "batch" (one batched http request for all of a
+# student's calendars) or "threads" (one request per calendar, in parallel on a bounded thread pool)
+CALENDAR_FETCH_STRATEGY = "batch"
+CALENDAR_FETCH_THREADS = 8
+# seconds a page load waits for calendars fetched with "threads", before rendering without them
+CALENDAR_FETCH_DEADLINE = 5
+# the django cache is kept in the database (table django_cache, see the release command in Procfile), so every
+# gunicorn worker and dyno shares it. Tests use a cache in the memory of their own process instead
+if "test" in sys.argv:
+    CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+            "LOCATION": "django_cache",
+        }
+    }
+# mirrored events are cached per calendar and shared by every student (see mainapp/event_cache.py)
+# EVENT_CACHE_ALIAS is the django cache shared between processes, the process-wide cache keeps at most
+# EVENT_CACHE_MAX_BYTES of events (0 disables the event cache), and entries expire after EVENT_CACHE_TTL seconds
+EVENT_CACHE_ALIAS = "default"
+EVENT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+EVENT_CACHE_TTL = 60
+# rendered todo lists are cached per student in the django cache TODO_CACHE_ALIAS (see tools.todo_list),
+# for at most TODO_CACHE_TTL seconds (0 disables the todo cache)
+TODO_CACHE_ALIAS = "default"
+TODO_CACHE_TTL = 300
+# rendered months of the calendar page are cached per student in MONTH_CACHE_ALIAS for MONTH_CACHE_TTL seconds
+# (0 disables the month cache, see mainapp/month_cache.py). The months around the one being viewed are rendered
+# ahead of time: "thread" on MONTH_PREFETCH_THREADS background threads, "inline" during the request, or "off".
+# Tests share an in-memory database that background threads cannot read, so they prefetch nothing
+MONTH_CACHE_ALIAS = "default"
+MONTH_CACHE_TTL = 600
+MONTH_PREFETCH = "off" if "test" in sys.argv else "thread"
+MONTH_PREFETCH_THREADS = 2
+# number of assignments per page of the agenda (see tools.agenda_page)
+AGENDA_PAGE_SIZE = 20
+# the daily digest job (see digest.run) is split into DIGEST_SHARDS shards, by "hash" or "range" of student id
+# this process runs shard DIGEST_SHARD, on DIGEST_WORKERS worker processes
+DIGEST_WORKERS = 1
+DIGEST_SHARD = 0
+DIGEST_SHARDS = 1
+DIGEST_SHARD_STRATEGY = "hash"
+# number of students read at a time when a class change is emailed to its class (see tools.send_all_messages)
+NOTIFICATION_BATCH_SIZE = 500
+# class changes wait this many seconds before they are sent, so changes made together go out in one email
+NOTIFICATION_COALESCE_WINDOW = 60
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
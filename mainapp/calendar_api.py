@@ -0,0 +1,196 @@
+import concurrent.futures
+import threading
+from django.conf import settings
+from . import services
+
+# calendar api query documentation : https://developers.google.com/calendar/api/v3/reference/events/list
+
+
+class CallCounter:
+    """
+    Counts the events().list calls made to google (every request of a batch counts toward the quota),
+    and the HTTP round trips they took. Shared by every thread of the process
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.round_trips = 0
+
+    def add(self, calls, round_trips=1):
+        with self.lock:
+            self.calls += calls
+            self.round_trips += round_trips
+
+    def snapshot(self):
+        """
+        Returns the counters so far. Subtract two snapshots to count the calls made in between
+        """
+        with self.lock:
+            return {"calls": self.calls, "round_trips": self.round_trips}
+
+
+counter = CallCounter()
+
+
+def iter_event_pages(calendarId, page_size=None, **query):
+    """
+    Lazily yields every page (raw response) of the events of the calendar with calendarId
+    The next page is only requested once the caller asks for it, by following nextPageToken
+    page_size is the number of events per page (maxResults), default settings.EVENT_PAGE_SIZE
+    Any extra keyword arguments are passed on to the events().list query (syncToken, etc)
+    """
+    query["maxResults"] = page_size if page_size != None else settings.EVENT_PAGE_SIZE
+    while True:
+        response = (
+            services.get_calendar_service().events()
+            .list(calendarId=calendarId, **query)
+            .execute()
+        )
+        counter.add(1)
+        yield response
+        if response.get("nextPageToken") == None:
+            return
+        query["pageToken"] = response["nextPageToken"]
+
+
+def iter_events(calendarId, page_size=None, **query):
+    """
+    Lazily yields the events of the calendar with calendarId, one page at a time
+    Stops requesting pages as soon as the caller stops consuming events
+    """
+    for page in iter_event_pages(calendarId, page_size=page_size, **query):
+        yield from page.get("items", [])
+
+
+def list_events(calendarId, **query):
+    """
+    Lists the events of the calendar with calendarId, following every page of the result
+    Any extra keyword arguments are passed on to the events().list query (syncToken, etc)
+    Returns a tuple of (items, nextSyncToken). nextSyncToken is only sent by google on the last page
+    """
+    items = []
+    page = {}
+    for page in iter_event_pages(calendarId, **query):
+        items += page.get("items", [])
+    return items, page.get("nextSyncToken", "")
+
+
+def window_query(time_min=None, time_max=None):
+    """
+    Returns the events().list query arguments for events that end after time_min and start before time_max
+    Recurring events are expanded into single events, ordered by start time
+    """
+    query = {"singleEvents": True, "orderBy": "startTime"}
+    if time_min != None:
+        query["timeMin"] = time_min.isoformat()
+    if time_max != None:
+        query["timeMax"] = time_max.isoformat()
+    return query
+
+
+def list_events_in_window(calendarId, time_min=None, time_max=None):
+    """
+    Lists the events of the calendar with calendarId that end after time_min and start before time_max
+    The window is applied by google (timeMin/timeMax), so only matching events are downloaded
+    """
+    return list(iter_events(calendarId, **window_query(time_min, time_max)))
+
+
+def iter_remaining_pages(calendarId, first_page, page_size=None, **query):
+    """
+    Yields first_page (a response that was already fetched, for instance in a batch), then lazily
+    follows its nextPageToken through the rest of the pages of the same query
+    """
+    yield first_page
+    if first_page.get("nextPageToken") != None:
+        yield from iter_event_pages(
+            calendarId,
+            page_size=page_size,
+            pageToken=first_page["nextPageToken"],
+            **query,
+        )
+
+
+# google accepts at most 50 requests in a single calendar api batch
+BATCH_LIMIT = 50
+
+
+def batch_first_pages(queries, page_size=None):
+    """
+    Requests the first page of events of several calendars in a single HTTP round trip (per 50 calendars)
+    queries is a list of (calendarId, query) pairs, where query holds extra events().list arguments
+    Returns a list with, for each query, either its first response page or the HttpError google sent back for it
+    batching documentation : https://developers.google.com/calendar/api/guides/batch
+    """
+    results = [None] * len(queries)
+
+    def callback(request_id, response, exception):
+        results[int(request_id)] = exception if exception != None else response
+
+    for start in range(0, len(queries), BATCH_LIMIT):
+        service = services.get_calendar_service()
+        batch = service.new_batch_http_request(callback=callback)
+        for i in range(start, min(start + BATCH_LIMIT, len(queries))):
+            calendarId, query = queries[i]
+            batch.add(
+                service.events().list(
+                    calendarId=calendarId,
+                    maxResults=page_size if page_size != None else settings.EVENT_PAGE_SIZE,
+                    **query,
+                ),
+                request_id=str(i),
+            )
+        batch.execute()
+        counter.add(min(start + BATCH_LIMIT, len(queries)) - start)
+    return results
+
+
+# shared by every request, so the number of threads talking to google stays bounded
+fetch_executor = None
+
+
+def get_fetch_executor():
+    """
+    Returns the thread pool used to fetch calendars concurrently, creating it on first use
+    """
+    global fetch_executor
+    if fetch_executor == None:
+        fetch_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=settings.CALENDAR_FETCH_THREADS,
+            thread_name_prefix="calendar-fetch",
+        )
+    return fetch_executor
+
+
+def fetch_pages_concurrently(queries, deadline=None, page_size=None):
+    """
+    Fetches every page of events of several calendars in parallel, one calendar per pool thread
+    (each thread uses its own calendar service, see services.get_calendar_service)
+    queries is a list of (calendarId, query) pairs, where query holds extra events().list arguments
+    Calendars that do not finish within deadline seconds (default settings.CALENDAR_FETCH_DEADLINE) are given up on
+    Returns a list with, for each query, either its list of response pages or the error that stopped it
+    (concurrent.futures.TimeoutError if it missed the deadline)
+    """
+    if deadline == None:
+        deadline = settings.CALENDAR_FETCH_DEADLINE
+
+    def fetch(calendarId, query):
+        return list(iter_event_pages(calendarId, page_size=page_size, **query))
+
+    futures = [
+        get_fetch_executor().submit(fetch, calendarId, dict(query))
+        for calendarId, query in queries
+    ]
+    concurrent.futures.wait(futures, timeout=deadline)
+
+    results = []
+    for future in futures:
+        if not future.done():
+            future.cancel()
+            results.append(concurrent.futures.TimeoutError())
+        elif future.exception() != None:
+            results.append(future.exception())
+        else:
+            results.append(future.result())
+    return results
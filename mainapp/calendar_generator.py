@@ -1,9 +1,10 @@
 # https://www.huiwenteo.com/normal/2018/07/24/django-calendar.html
 
 
-from datetime import datetime
+from collections import defaultdict
 from calendar import HTMLCalendar
-from . import tools
+from . import month_cache, tools
+from .event import as_event
 
 
 class Calendar(HTMLCalendar):
@@ -12,49 +13,60 @@ class Calendar(HTMLCalendar):
         self.month = month
         super(Calendar, self).__init__()
 
-    # formats a day as a td
-    # filter events by day
-    def formatday(self, day, events, request):
-        events_per_day = [
-            event
-            for event in events
-            if datetime.fromisoformat(event["end"]["dateTime"]).day == day
-        ]
-        d = ""
-        for event in events_per_day:
-            d += f"""
-			<div style="z-index:9999; padding-left:10%; padding-right:10%; width:100%;border-radius:1.5vh;color:{"white" if not tools.is_checked_off(request, event) else "gray"};margin-bottom:5px; background-color:{tools.get_color(request, event['description'])}; display: -webkit-box;
-                -webkit-line-clamp: 4;
-                -webkit-box-orient: vertical;
-                overflow:hidden;
-                overflow-wrap:break-word;
-                max-width:15vw;
-                ">
-				{event['summary']}
+    # groups events by the day they end on, parsing every event once (see event.Event)
+    def bucket_events(self, events):
+        days = defaultdict(list)
+        for event in map(as_event, events):
+            days[event.end.day].append(event)
+        return days
+
+    # formats an Event as a div
+    # colors come from the stylesheet of the student (see tools.student_css)
+    def formatevent(self, event, request):
+        checked = " checked" if tools.is_checked_off(request, event) else ""
+        return f"""
+			<div class="calendar-event{checked} {tools.class_css_classes(event.description)}">
+				{event.summary}
 			</div>
 			"""
 
+    # formats a day as a td
+    # events are the events that end on this day
+    def formatday(self, day, events, request):
         if day != 0:
+            d = "".join(self.formatevent(event, request) for event in events)
             return f"<td><span class='date'>{day}</span><ul> {d} </ul></td>"
         return "<td></td>"
 
     # formats a week as a tr
-    def formatweek(self, theweek, events, request):
-        week = ""
-        for d, _ in theweek:
-            week += self.formatday(d, events, request)
+    # days maps each day of the month to the events that end on it
+    def formatweek(self, theweek, days, request):
+        week = "".join(self.formatday(d, days.get(d, []), request) for d, _ in theweek)
         return f"<tr> {week} </tr>"
 
     # formats a month as a table
     # filter events by year and month
-
+    # rendered months are cached per student, and the months around it are rendered ahead (see month_cache)
     def formatmonth(self, request, withyear=True):
         print("Grabbing month", self.month)
-        events = tools.get_events(request, month=self.month, year=self.year)
-        cal = f'<table border="0" cellpadding="0" cellspacing="0" class="calendar">\n'
-        cal += f"{self.formatmonthname(self.year, self.month, withyear=withyear)}\n"
-        cal += f"{self.formatweekheader()}\n"
-        for week in self.monthdays2calendar(self.year, self.month):
-            cal += f"{self.formatweek(week, events, request)}\n"
-        return cal
+        key = month_cache.month_key(request, self.year, self.month, withyear)
+        html = month_cache.cached_month(key)
+        if html == None:
+            events = tools.get_events(request, month=self.month, year=self.year)
+            html = self.render_month(events, request, withyear=withyear)
+            month_cache.cache_month(key, html)
+        month_cache.prefetch_adjacent(request, self.year, self.month, withyear)
+        # classes whose calendar could not be loaded in time are listed above the month
+        return tools.missing_calendars_html(request) + html
 
+    # formats already fetched events of this month as a table
+    def render_month(self, events, request, withyear=True):
+        days = self.bucket_events(events)
+        cal = [
+            f'<table border="0" cellpadding="0" cellspacing="0" class="calendar">\n',
+            f"{self.formatmonthname(self.year, self.month, withyear=withyear)}\n",
+            f"{self.formatweekheader()}\n",
+        ]
+        for week in self.monthdays2calendar(self.year, self.month):
+            cal.append(f"{self.formatweek(week, days, request)}\n")
+        return "".join(cal)
@@ -1,32 +1,45 @@
+from django.utils.functional import SimpleLazyObject
 from . import tools
 
+# every value is lazy: it is only computed if the template reads it, and then at most once per request.
+# they share the student of the request (tools.get_student) and the class of the page (tools.current_class)
+
 
 def is_professor(request):
-    return {"USER_IS_PROFESSOR": tools.is_professor(request)}
+    return {"USER_IS_PROFESSOR": SimpleLazyObject(lambda: tools.is_professor(request))}
 
 
 def get_class_color(request):
-    return {"CLASS_COLOR": tools.get_color(request, tools.className_from_url(request))}
-
-
-def is_assigned_professor(request):
     return {
-        "IS_ASSIGNED_PROFESSOR": tools.is_professor_for_class(
-            request, tools.className_from_url(request)
+        "CLASS_COLOR": SimpleLazyObject(
+            lambda: tools.class_color(request, tools.current_class(request))
         )
     }
 
 
+def is_assigned_professor(request):
+    def assigned_professor():
+        if not tools.student_exists(request):
+            return False
+        clazz = tools.current_class(request)
+        # outside of a class page (or on a personal calendar), we have full rights
+        return clazz == None or clazz.professorId == tools.get_student(request).userId
+
+    return {"IS_ASSIGNED_PROFESSOR": SimpleLazyObject(assigned_professor)}
+
+
 def is_my_class(request):
-    return {
-        "IS_MY_CLASS": tools.class_exists_for_student(
-            request, tools.className_from_url(request)
-        )
-    }
+    def my_class():
+        if not tools.student_exists(request):
+            return False
+        return tools.current_class(request) in tools.get_student(request).classes
+
+    return {"IS_MY_CLASS": SimpleLazyObject(my_class)}
+
 
 def get_name(request):
-    return {
-        "USERNAME": tools.get_username(
-            request
-        )
-    }
\ No newline at end of file
+    return {"USERNAME": SimpleLazyObject(lambda: tools.get_username(request))}
+
+
+def get_student_css(request):
+    return {"STUDENT_CSS": SimpleLazyObject(lambda: tools.student_css_url(request))}
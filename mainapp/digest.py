@@ -0,0 +1,242 @@
+import concurrent.futures
+import datetime
+import multiprocessing
+import time
+import pytz
+from django.conf import settings
+from django.db import connections
+from django.db.models import Max, Min, Value
+from django.db.models.functions import Mod
+from . import calendar_api, models, services, tools
+from .timeline import Timeline
+
+# The daily digest emails every student the assignments they have due today.
+# Several dynos can split the job: students are split into shards, either by hash (student id modulo the
+# number of shards) or by ranges of student ids. Each dyno can run its shard on several worker processes
+# (workers), each with its own database connection and calendar client, which split the shard between them.
+# Every part runs in two phases: each calendar of its students is read once, then matched to the
+# students in memory. The coordinator (run) merges the progress and failures of every part.
+
+
+def run(day=None, workers=None, shard=None, shards=None, strategy=None):
+    """
+    Sends the daily digest to the students of shard (of shards), split across workers processes
+    Missing arguments default to settings.DIGEST_WORKERS, DIGEST_SHARD, DIGEST_SHARDS and DIGEST_SHARD_STRATEGY
+    Returns (and prints) the merged counts of every part: students notified, calendars read, calendar api
+    calls, failures, and the seconds taken
+    """
+    started = time.perf_counter()
+    if day == None:
+        # this is to fix a weird date offset where dates are being reported as one day in advance
+        day = datetime.datetime.now(tz=pytz.UTC) - datetime.timedelta(days=1)
+    workers = settings.DIGEST_WORKERS if workers == None else workers
+    shard = settings.DIGEST_SHARD if shard == None else shard
+    shards = settings.DIGEST_SHARDS if shards == None else shards
+    strategy = settings.DIGEST_SHARD_STRATEGY if strategy == None else strategy
+    if workers < 1 or not 0 <= shard < shards:
+        raise ValueError(f"Cannot run digest shard {shard} of {shards} on {workers} workers")
+
+    # the students of a shard do not depend on workers, so dynos can use different numbers of workers
+    results = []
+    if workers == 1:
+        results.append(run_safely(day, shard, shards, 0, 1, strategy))
+    else:
+        # forked processes must not inherit open database connections (see initialize_worker)
+        connections.close_all()
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=initialize_worker,
+        ) as pool:
+            futures = {
+                pool.submit(run_safely, day, shard, shards, worker, workers, strategy): worker
+                for worker in range(workers)
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # the worker process itself died
+                    result = failed_part(shard, futures[future], e)
+                results.append(result)
+                print(f"Daily digest shard {shard} worker {futures[future]} of {workers} done", result)
+
+    stats = merge(results)
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    print("Daily digest done", stats)
+    return stats
+
+
+def initialize_worker():
+    """
+    Runs once in every worker process. Forked processes must not share the database connections
+    or the calendar client of the process that started them
+    The connections are closed by the parent before it forks. Any handle still inherited is dropped without being
+    closed, as closing it would also end the server session of the parent (postgres)
+    """
+    for connection in connections.all():
+        connection.connection = None
+    services.initialize_services_for_worker()
+
+
+def run_safely(day, shard, shards, worker, workers, strategy):
+    """
+    Runs a part of the digest, returning its failure instead of raising it, so the other parts go on
+    """
+    try:
+        return run_part(day, shard, shards, worker, workers, strategy)
+    except Exception as e:
+        import traceback
+
+        traceback.print_exc()
+        return failed_part(shard, worker, e)
+
+
+def failed_part(shard, worker, error):
+    """
+    Returns the counts of a part that failed before it finished
+    """
+    return {"parts": 1, "failures": [f"shard {shard} worker {worker}: {error!r}"]}
+
+
+def run_part(day, shard, shards, worker, workers, strategy):
+    """
+    Sends the daily digest to the students of a worker of a shard (see part_students)
+    """
+    calls_before = calendar_api.counter.snapshot()
+    students = list(
+        part_students(shard, shards, worker, workers, strategy).only("id", "userId", "name", "calendarId")
+    )
+    classes = enrollments([student.pk for student in students])
+    calendarIds = list(
+        dict.fromkeys(
+            [student.calendarId for student in students]
+            + [calendarId for enrolled in classes.values() for _, calendarId in enrolled]
+        )
+    )
+
+    # phase one : every calendar, once
+    events, failures = fetch_events(calendarIds, day)
+
+    # phase two : every student, from the events of their calendars
+    notified = 0
+    for student in students:
+        student_events = list(events.get(student.calendarId, []))
+        for className, calendarId in classes.get(student.pk, []):
+            student_events += [dict(event, className=className) for event in events.get(calendarId, [])]
+        timeline = Timeline(student_events, now=day)
+        if len(timeline) != 0:
+            print("Sending daily assignment update")
+            tools.send_message(student.userId, message(student, timeline))
+            notified += 1
+
+    calls_after = calendar_api.counter.snapshot()
+    return {
+        "parts": 1,
+        "students": len(students),
+        "notified": notified,
+        "calendars": len(calendarIds),
+        "api_calls": calls_after["calls"] - calls_before["calls"],
+        "round_trips": calls_after["round_trips"] - calls_before["round_trips"],
+        "failures": failures,
+    }
+
+
+def merge(results):
+    """
+    Adds up the counts of every part, and gathers their failures
+    """
+    stats = {
+        "parts": 0,
+        "students": 0,
+        "notified": 0,
+        "calendars": 0,
+        "api_calls": 0,
+        "round_trips": 0,
+        "failures": [],
+    }
+    for result in results:
+        for name, value in result.items():
+            stats[name] += value
+    return stats
+
+
+def part_students(shard, shards, worker=0, workers=1, strategy="hash"):
+    """
+    Returns the students of a worker (numbered from 0, out of workers) of a shard (numbered from 0, out of shards)
+    The students of a shard only depend on shard and shards, they are then split between the workers of the shard
+    "hash" takes the students whose id modulo shards is shard, "range" splits the ids into shards equal ranges
+    """
+    if strategy not in ["hash", "range"]:
+        raise ValueError(f"Unknown digest shard strategy {strategy}")
+    students = models.Student.objects.all()
+    if shards * workers == 1:
+        return students
+    if strategy == "hash":
+        # id modulo shards is shard exactly when id modulo (shards * workers) is shard plus a multiple of shards
+        return students.annotate(part=Mod("id", Value(shards * workers))).filter(part=shard + shards * worker)
+    bounds = students.aggregate(low=Min("id"), high=Max("id"))
+    if bounds["low"] == None:
+        return students.none()
+    shard_span = (bounds["high"] - bounds["low"]) // shards + 1
+    shard_start = bounds["low"] + shard * shard_span
+    span = -(-shard_span // workers)
+    start = shard_start + worker * span
+    return students.filter(id__gte=start, id__lt=min(start + span, shard_start + shard_span))
+
+
+def enrollments(student_ids):
+    """
+    Returns a dictionary from student id to the (className, calendarId) pairs of their classes, in one query
+    """
+    classes = {}
+    for student_id, className, calendarId in models.Enrollment.objects.filter(
+        student_id__in=student_ids
+    ).values_list("student_id", "clazz__className", "clazz__calendarId").order_by("clazz__className"):
+        classes.setdefault(student_id, []).append((className, calendarId))
+    return classes
+
+
+def fetch_events(calendarIds, day):
+    """
+    Returns a dictionary from calendarId to the events of that calendar ending on day, reading each calendar once,
+    and the calendars that failed. The calendars are refreshed together first. Calendars that fail are left out,
+    so their students still get the rest of their digest
+    """
+    failures = tools.refresh_calendars(calendarIds)
+    events = {}
+    for calendarId in calendarIds:
+        if calendarId in failures:
+            print("Leaving calendar", calendarId, "out of the daily digest")
+            continue
+        events[calendarId] = tools.get_events_from_calendar(
+            calendarId, day=day.day, month=day.month, year=day.year
+        )
+    return events, [f"calendar {calendarId}: {error!r}" for calendarId, error in failures.items()]
+
+
+def message(student, timeline):
+    """
+    Returns the daily digest email of a student, for the Timeline of their assignments due today
+    """
+    # grouped by class, and in the order they are due within a class
+    events = sorted(timeline, key=lambda event: str(event.className))
+    last_class = events[0].className
+    last_class_str = "Personal" if last_class == None else last_class
+    event_string = f"For {last_class_str}:<br>"
+    for event in events:
+        if last_class != event.className:
+            last_class = event.className
+            last_class_str = "Personal" if last_class == None else last_class
+            event_string += f"For {last_class_str}:<br>"
+        event_string += f"&emsp;{event.summary}<br>"
+    return f"""
+Dear {student.name},<br>
+<br>
+You have some assignments due today:<br>
+<br>
+{event_string}<br>
+<br>
+Good luck on your classes,<br>
+Assignment Organizer
+            """
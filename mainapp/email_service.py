@@ -9,10 +9,12 @@ import time
 
 # setup from https://towardsdatascience.com/e-mails-notification-bot-with-python-4efa227278fb
 class EmailService:
-    def __init__(self):
+    def __init__(self, digest_options=None):
         """
         Initializes the email service **only** if the device is running on a deployed server
+        digest_options are passed on to the daily digest job (see tools.notify_students_of_today_assignments)
         """
+        self.digest_options = digest_options or {}
         self.login()
         t = threading.Thread(target=self.setup_notification_cycle)
         t.setDaemon(True)
@@ -56,11 +58,13 @@ class EmailService:
 
             # every day at 1AM update daily assignments and queue messages to be sent
             schedule.every().day.at("01:00:00").do(
-                tools.notify_students_of_today_assignments
+                tools.notify_students_of_today_assignments, **self.digest_options
             )
 
             # every 10 minutes check for a class assignment change and send messages out
-            schedule.every(10).minutes.do(tools.send_all_messages)
+            # when several dynos split the digest, only the one running shard 0 sends, so nothing is sent twice
+            if not self.digest_options.get("shard"):
+                schedule.every(10).minutes.do(tools.send_all_messages)
 
             self.notification_cycle()
         except AppRegistryNotReady:
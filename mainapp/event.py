@@ -0,0 +1,71 @@
+import datetime
+import pytz
+
+
+def parse_datetime(value):
+    """
+    Parses an isoformat date from the calendar api into an aware datetime
+    Dates without a timezone are assumed to be in UTC
+    """
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo == None:
+        parsed = pytz.utc.localize(parsed)
+    return parsed
+
+
+def event_end(event):
+    """
+    Returns the end of an event dictionary from the calendar api as an aware datetime, or None if it has no end
+    All-day events only have an end date, and end at midnight (UTC) of that date
+    """
+    end = event.get("end", {})
+    end = end.get("dateTime", end.get("date"))
+    if end == None:
+        return None
+    return parse_datetime(end)
+
+
+class Event:
+    """
+    An assignment (event of a google calendar), parsed once when it is fetched
+    Only keeps the fields pages render. end is an aware datetime, or None if the event has no end time
+    organizer is the email (calendarId) of the calendar that created the event
+    """
+
+    __slots__ = ("id", "summary", "description", "className", "organizer", "end")
+
+    def __init__(
+        self, id=None, summary="", description=None, className=None, organizer=None, end=None
+    ):
+        self.id = id
+        self.summary = summary
+        self.description = description
+        self.className = className
+        self.organizer = organizer
+        self.end = end
+
+    @classmethod
+    def from_google(cls, event):
+        """
+        Creates an Event from an event dictionary returned by the calendar api (see tools.get_events)
+        """
+        return cls(
+            id=event.get("id"),
+            summary=event.get("summary", ""),
+            description=event.get("description"),
+            className=event.get("className"),
+            organizer=event.get("organizer", {}).get("email"),
+            end=event_end(event),
+        )
+
+    def __repr__(self):
+        return f"Event({self.summary!r}, end={self.end!r})"
+
+
+def as_event(event):
+    """
+    Returns event as an Event, parsing it if it still is a dictionary from the calendar api
+    """
+    if isinstance(event, Event):
+        return event
+    return Event.from_google(event)
@@ -0,0 +1,154 @@
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+
+# Class calendars are the same for every student in the class, so the mirrored events of a calendar are
+# cached once and shared by every student. There are two tiers:
+#   - a process-wide LRU cache, bounded by settings.EVENT_CACHE_MAX_BYTES, that avoids touching the database
+#   - the django cache named settings.EVENT_CACHE_ALIAS, shared between processes when it is a shared backend
+# Entries are tagged with the version of the calendar's CalendarSync row, and any change to the mirror
+# (a sync or a write-through) changes the version, so an entry never outlives the events it was built from.
+# Both tiers also expire entries after settings.EVENT_CACHE_TTL seconds.
+
+
+class EventCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, calendarId, version):
+        """
+        Returns the cached events of calendarId at version, or None if they are not cached
+        """
+        with self.lock:
+            entry = self.entries.get(calendarId)
+            if entry != None and entry["version"] == version and entry["expires"] > time.monotonic():
+                self.entries.move_to_end(calendarId)
+                self.hits += 1
+                return entry["events"]
+
+        events = shared_cache().get(shared_key(calendarId, version))
+        with self.lock:
+            if events == None:
+                self.misses += 1
+                return None
+            self.shared_hits += 1
+        self.put(calendarId, version, events)
+        return events
+
+    def set(self, calendarId, version, events):
+        """
+        Caches the events of calendarId at version in both tiers
+        """
+        shared_cache().set(
+            shared_key(calendarId, version), events, timeout=settings.EVENT_CACHE_TTL
+        )
+        self.put(calendarId, version, events)
+
+    def put(self, calendarId, version, events):
+        """
+        Caches the events of calendarId at version in the process-wide tier, evicting the least
+        recently used calendars until everything fits in settings.EVENT_CACHE_MAX_BYTES
+        """
+        size = len(pickle.dumps(events, pickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            self.remove(calendarId)
+            if size > settings.EVENT_CACHE_MAX_BYTES:
+                return
+            self.entries[calendarId] = {
+                "version": version,
+                "events": events,
+                "size": size,
+                "expires": time.monotonic() + settings.EVENT_CACHE_TTL,
+            }
+            self.size += size
+            while self.size > settings.EVENT_CACHE_MAX_BYTES:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted["size"]
+                self.evictions += 1
+
+    def patch(self, calendarId, version, new_version, update):
+        """
+        Applies update (a function from the cached events to the new events) to the process-wide
+        entry of calendarId, if it is cached at version, and re-tags it with new_version
+        Otherwise the entry is dropped, and the next read loads the calendar again
+        """
+        with self.lock:
+            entry = self.entries.get(calendarId)
+            events = None
+            if entry != None and entry["version"] == version:
+                events = update(entry["events"])
+        if events == None:
+            self.invalidate(calendarId)
+            return
+        self.put(calendarId, new_version, events)
+
+    def invalidate(self, calendarId):
+        """
+        Drops the process-wide entry of calendarId. Shared entries are tagged with the old version,
+        so they are never read again
+        """
+        with self.lock:
+            self.remove(calendarId)
+
+    def remove(self, calendarId):
+        """
+        Drops the process-wide entry of calendarId. Must be called with the lock held
+        """
+        entry = self.entries.pop(calendarId, None)
+        if entry != None:
+            self.size -= entry["size"]
+
+    def clear(self):
+        """
+        Drops every process-wide entry and resets the counters
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.hits = 0
+            self.shared_hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """
+        Returns the hit and miss counters and the current size of the process-wide tier
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "calendars": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": settings.EVENT_CACHE_MAX_BYTES,
+            }
+
+
+def shared_cache():
+    """
+    Returns the django cache used as the cross-process tier
+    """
+    return caches[settings.EVENT_CACHE_ALIAS]
+
+
+def shared_key(calendarId, version):
+    """
+    Returns the key of the events of calendarId at version in the cross-process tier
+    calendarIds are hashed, since they can hold characters that memcached does not allow in keys
+    """
+    return f"events:{hashlib.sha1(calendarId.encode()).hexdigest()}:{version}"
+
+
+cache = EventCache()
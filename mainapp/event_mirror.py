@@ -0,0 +1,362 @@
+import uuid
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from googleapiclient.errors import HttpError
+from . import calendar_api, models
+from .event import event_end
+from .event_cache import cache
+
+# incremental sync documentation : https://developers.google.com/calendar/api/guides/sync
+
+
+def get_events(calendarId, time_min=None, time_max=None):
+    """
+    Returns all events of the calendar with calendarId from the local mirror
+    If time_min or time_max are given, only events ending in [time_min, time_max) are returned
+    If the mirror is older than settings.EVENT_MIRROR_MAX_AGE seconds, it is synced with google first
+    """
+    return list(iter_events(calendarId, time_min=time_min, time_max=time_max))
+
+
+def iter_events(calendarId, time_min=None, time_max=None, page_size=None):
+    """
+    Lazily yields the events of the calendar with calendarId from the local mirror (see get_events)
+    The whole calendar is cached, and shared by every student reading it (see event_cache)
+    Without the cache, rows are read from the database page_size at a time, default settings.EVENT_PAGE_SIZE
+    """
+    state = get_sync_state(calendarId)
+    if is_stale(state):
+        sync(state)
+
+    if settings.EVENT_CACHE_MAX_BYTES > 0:
+        entries = cache.get(str(calendarId), state.version)
+        if entries == None:
+            entries = [
+                (event.end, event.body)
+                for event in models.MirroredEvent.objects.filter(
+                    calendarId=calendarId
+                ).order_by("id")
+            ]
+            cache.set(str(calendarId), state.version, entries)
+        for end, body in entries:
+            if time_min != None and (end == None or end < time_min):
+                continue
+            if time_max != None and (end == None or end >= time_max):
+                continue
+            # cached events are shared, so callers get their own copy to tag
+            yield dict(body)
+        return
+
+    events = models.MirroredEvent.objects.filter(calendarId=calendarId)
+    if time_min != None:
+        events = events.filter(end__gte=time_min)
+    if time_max != None:
+        events = events.filter(end__lt=time_max)
+    chunk_size = page_size if page_size != None else settings.EVENT_PAGE_SIZE
+    for event in events.order_by("id").iterator(chunk_size=chunk_size):
+        yield event.body
+
+
+def get_page(calendarIds, time_min=None, time_max=None, cursor=None, reverse=False, limit=None):
+    """
+    Returns up to limit (calendarId, event) pairs from the mirrors of calendarIds, for events ending in
+    [time_min, time_max), ordered by end and then event id (latest first with reverse)
+    cursor is the (end, eventId) of the last event of the previous page, the page starts right after it
+    Pages are read with a keyset query, so a page costs the same however many events come before it
+    The calendars should already be refreshed (see refresh)
+    """
+    events = models.MirroredEvent.objects.filter(
+        calendarId__in=[str(calendarId) for calendarId in calendarIds], end__isnull=False
+    )
+    if time_min != None:
+        events = events.filter(end__gte=time_min)
+    if time_max != None:
+        events = events.filter(end__lt=time_max)
+    if cursor != None:
+        end, eventId = cursor
+        if reverse:
+            events = events.filter(Q(end__lt=end) | Q(end=end, eventId__lt=eventId))
+        else:
+            events = events.filter(Q(end__gt=end) | Q(end=end, eventId__gt=eventId))
+    events = events.order_by("-end", "-eventId") if reverse else events.order_by("end", "eventId")
+    if limit != None:
+        events = events[:limit]
+    return [(event.calendarId, event.body) for event in events]
+
+
+def get_sync_state(calendarId):
+    """
+    Returns the CalendarSync row for calendarId, creating it if this calendar was never mirrored
+    """
+    state, _ = models.CalendarSync.objects.get_or_create(calendarId=calendarId)
+    return state
+
+
+def get_sync_states(calendarIds):
+    """
+    Returns the CalendarSync rows for every calendarId in calendarIds (in order), creating missing ones
+    """
+    states = {
+        state.calendarId: state
+        for state in models.CalendarSync.objects.filter(calendarId__in=calendarIds)
+    }
+    for calendarId in calendarIds:
+        if str(calendarId) not in states:
+            states[str(calendarId)] = get_sync_state(calendarId)
+    return [states[str(calendarId)] for calendarId in calendarIds]
+
+
+def is_stale(state):
+    """
+    Returns whether or not the mirror for a CalendarSync row needs to be synced before it is read
+    """
+    if state.synced_at == None:
+        return True
+    age = timezone.now() - state.synced_at
+    return age.total_seconds() > settings.EVENT_MIRROR_MAX_AGE
+
+
+def mark_stale(calendarId):
+    """
+    Forces the next read of calendarId to sync with google. Used after we write to a calendar
+    """
+    models.CalendarSync.objects.filter(calendarId=calendarId).update(synced_at=None)
+
+
+def sync(state):
+    """
+    Brings the mirror for a CalendarSync row up to date
+    Uses an incremental sync if we have a syncToken, otherwise (or if google expired the token) a full sync
+    """
+    try:
+        apply_pages(
+            state, calendar_api.iter_event_pages(state.calendarId, **sync_query(state))
+        )
+    except HttpError as e:
+        if not is_expired(state, e):
+            raise
+        full_sync(state)
+
+
+def full_sync(state):
+    """
+    Replaces every mirrored event of a calendar with a fresh copy from google
+    """
+    print("Full sync for calendar", state.calendarId)
+    state.syncToken = ""
+    apply_pages(state, calendar_api.iter_event_pages(state.calendarId))
+
+
+def refresh(calendarIds):
+    """
+    Syncs every stale calendar in calendarIds, fetching them all at once with settings.CALENDAR_FETCH_STRATEGY:
+    "batch" requests the first page of every stale calendar in one batched HTTP round trip,
+    "threads" fetches every stale calendar in parallel on a thread pool, within settings.CALENDAR_FETCH_DEADLINE
+    Returns a dictionary from calendarId to the error that stopped it from syncing, for calendars that failed
+    (concurrent.futures.TimeoutError for calendars that missed the deadline)
+    """
+    return refresh_versions(calendarIds)[0]
+
+
+def refresh_versions(calendarIds):
+    """
+    Syncs every stale calendar in calendarIds (see refresh). Returns the failures, and a dictionary from
+    calendarId to the version of its mirror once it is up to date
+    """
+    states = get_sync_states(list(dict.fromkeys(calendarIds)))
+    failures = refresh_states(states)
+    return failures, {str(state.calendarId): state.version for state in states}
+
+
+def refresh_states(states):
+    """
+    Syncs the stale CalendarSync rows in states (see refresh), and returns the failures
+    """
+    stale = [state for state in states if is_stale(state)]
+    if len(stale) == 0:
+        return {}
+
+    queries = [(state.calendarId, sync_query(state)) for state in stale]
+    if settings.CALENDAR_FETCH_STRATEGY == "threads":
+        # the threads only talk to google, the mirror is written from this thread
+        results = calendar_api.fetch_pages_concurrently(queries)
+    else:
+        results = [
+            first_page
+            if isinstance(first_page, Exception)
+            else calendar_api.iter_remaining_pages(calendarId, first_page, **query)
+            for (calendarId, query), first_page in zip(
+                queries, calendar_api.batch_first_pages(queries)
+            )
+        ]
+
+    failures = {}
+    for state, pages in zip(stale, results):
+        # timeouts and connection errors from the fetch threads
+        if isinstance(pages, Exception) and not isinstance(pages, HttpError):
+            failures[state.calendarId] = pages
+            continue
+        try:
+            if isinstance(pages, HttpError):
+                raise pages
+            apply_pages(state, pages)
+        except HttpError as e:
+            if not is_expired(state, e):
+                failures[state.calendarId] = e
+                continue
+            try:
+                full_sync(state)
+            except HttpError as e:
+                failures[state.calendarId] = e
+    return failures
+
+
+def sync_query(state):
+    """
+    Returns the extra events().list arguments for the next sync of a CalendarSync row
+    """
+    if state.syncToken != "":
+        return {"syncToken": state.syncToken}
+    return {}
+
+
+def is_expired(state, error):
+    """
+    Returns whether or not an HttpError means the sync token of a CalendarSync row expired
+    410 GONE means the sync token is no longer valid, and we need to start over with a full sync
+    """
+    if state.syncToken == "" or error.resp.status != 410:
+        return False
+    print("Sync token expired for calendar", state.calendarId)
+    return True
+
+
+def apply_pages(state, pages):
+    """
+    Writes the pages of a sync to the mirror, one page at a time as the pages arrive
+    Without a syncToken every mirrored event is replaced. With one, only the changes are applied:
+    cancelled events are removed, everything else is inserted or updated
+    The CalendarSync row is locked while the pages are written, so a calendar is synced by one reader at a time.
+    If another reader synced it while this one waited for the lock, the pages are not applied
+    """
+    sync_token = ""
+    changed = state.syncToken == ""
+    with transaction.atomic():
+        locked = models.CalendarSync.objects.select_for_update().get(pk=state.pk)
+        if not is_stale(locked):
+            state.syncToken = locked.syncToken
+            state.synced_at = locked.synced_at
+            state.version = locked.version
+            return
+        if state.syncToken == "":
+            models.MirroredEvent.objects.filter(calendarId=state.calendarId).delete()
+        for page in pages:
+            items = page.get("items", [])
+            if state.syncToken == "":
+                models.MirroredEvent.objects.bulk_create(
+                    [mirrored_event(state.calendarId, item) for item in items],
+                    ignore_conflicts=True,
+                )
+            else:
+                apply_changes(state.calendarId, items)
+                changed = changed or len(items) != 0
+            sync_token = page.get("nextSyncToken", "")
+        if changed:
+            state.version = uuid.uuid4().hex
+        save_sync_state(state, sync_token)
+
+
+def save_event(calendarId, item):
+    """
+    Writes an event we just created (or updated) on google through to the mirror and the event cache,
+    so it shows up without waiting for the next sync
+    """
+    state = get_sync_state(calendarId)
+    old_version = state.version
+    with transaction.atomic():
+        upsert(calendarId, item)
+        set_version(state)
+    event = mirrored_event(calendarId, item)
+
+    def update(entries):
+        return [
+            entry for entry in entries if entry[1].get("id") != event.eventId
+        ] + [(event.end, item)]
+
+    cache.patch(str(calendarId), old_version, state.version, update)
+
+
+def remove_event(calendarId, eventId):
+    """
+    Removes an event we just deleted on google from the mirror and the event cache
+    """
+    state = get_sync_state(calendarId)
+    old_version = state.version
+    with transaction.atomic():
+        models.MirroredEvent.objects.filter(
+            calendarId=calendarId, eventId=eventId
+        ).delete()
+        set_version(state)
+
+    def update(entries):
+        return [entry for entry in entries if entry[1].get("id") != eventId]
+
+    cache.patch(str(calendarId), old_version, state.version, update)
+
+
+def set_version(state):
+    """
+    Gives the mirror of a CalendarSync row a new version, after we wrote to it
+    Only the version is written, so a sync finishing meanwhile keeps its syncToken and synced_at
+    """
+    state.version = uuid.uuid4().hex
+    models.CalendarSync.objects.filter(pk=state.pk).update(version=state.version)
+
+
+def apply_changes(calendarId, items):
+    """
+    Applies the changed events of an incremental sync to the mirror of a calendar
+    """
+    for item in items:
+        if item.get("status") == "cancelled":
+            models.MirroredEvent.objects.filter(
+                calendarId=calendarId, eventId=item["id"]
+            ).delete()
+        else:
+            upsert(calendarId, item)
+
+
+def upsert(calendarId, item):
+    """
+    Inserts or updates a single mirrored event
+    An event inserted by someone else since the update is kept, (calendarId, eventId) is unique
+    """
+    event = mirrored_event(calendarId, item)
+    updated = models.MirroredEvent.objects.filter(
+        calendarId=calendarId, eventId=event.eventId
+    ).update(end=event.end, body=event.body)
+    if updated == 0:
+        models.MirroredEvent.objects.bulk_create([event], ignore_conflicts=True)
+
+
+def save_sync_state(state, sync_token):
+    """
+    Records a finished sync. An empty sync_token means the next sync will be a full sync
+    """
+    state.syncToken = sync_token
+    state.synced_at = timezone.now()
+    state.save()
+
+
+def mirrored_event(calendarId, item):
+    """
+    Creates an (unsaved) MirroredEvent from an event returned by the calendar api
+    """
+    return models.MirroredEvent(
+        calendarId=calendarId,
+        eventId=item.get("id", ""),
+        end=event_end(item),
+        body=item,
+    )
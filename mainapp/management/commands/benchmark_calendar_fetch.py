@@ -0,0 +1,41 @@
+import datetime
+import json
+import time
+from django.core.management.base import BaseCommand
+from mainapp import calendar_api, tools
+
+# compares downloading a whole calendar against only downloading a time window of it
+class Command(BaseCommand):
+    help = "Compares payload size and latency of a full calendar fetch against a windowed fetch"
+
+    def add_arguments(self, parser):
+        parser.add_argument("calendarId")
+        parser.add_argument("--year", type=int, default=datetime.date.today().year)
+        parser.add_argument("--month", type=int, default=datetime.date.today().month)
+        parser.add_argument("--day", type=int, default=None)
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        calendarId = options["calendarId"]
+        time_min, time_max = tools.time_window(
+            day=options["day"], month=options["month"], year=options["year"]
+        )
+
+        def full_fetch():
+            items, _ = calendar_api.list_events(calendarId)
+            return items
+
+        def windowed_fetch():
+            return calendar_api.list_events_in_window(calendarId, time_min, time_max)
+
+        for name, fetch in (("full", full_fetch), ("windowed", windowed_fetch)):
+            timings = []
+            for _ in range(options["repeat"]):
+                start = time.perf_counter()
+                items = fetch()
+                timings.append(time.perf_counter() - start)
+            payload = len(json.dumps(items).encode("utf-8"))
+            self.stdout.write(
+                f"{name:>8}: {len(items):5d} events, {payload:9d} payload bytes, "
+                f"best {min(timings) * 1000:8.1f} ms, mean {sum(timings) / len(timings) * 1000:8.1f} ms"
+            )
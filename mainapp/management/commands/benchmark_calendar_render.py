@@ -0,0 +1,112 @@
+import datetime
+import random
+import time
+from django.core.management.base import BaseCommand
+from mainapp import event as event_module, tools
+from mainapp.calendar_generator import Calendar
+
+
+# the month renderer before events were bucketed by day, kept as a baseline:
+# every cell scans (and parses) every event of the month, and html is built with +=
+class LegacyCalendar(Calendar):
+    def formatday(self, day, events, request):
+        events_per_day = [
+            event
+            for event in events
+            if event_module.parse_datetime(event["end"]["dateTime"]).day == day
+        ]
+        d = ""
+        for event in events_per_day:
+            d += f"""
+			<div style="z-index:9999; padding-left:10%; padding-right:10%; width:100%;border-radius:1.5vh;color:{"white" if (str(event['className']), str(event['id'])) not in request.checked_assignments else "gray"};margin-bottom:5px; background-color:{tools.get_color(request, event['description'])}; display: -webkit-box;
+                -webkit-line-clamp: 4;
+                -webkit-box-orient: vertical;
+                overflow:hidden;
+                overflow-wrap:break-word;
+                max-width:15vw;
+                ">
+				{event['summary']}
+			</div>
+			"""
+        if day != 0:
+            return f"<td><span class='date'>{day}</span><ul> {d} </ul></td>"
+        return "<td></td>"
+
+    def formatweek(self, theweek, events, request):
+        week = ""
+        for d, _ in theweek:
+            week += self.formatday(d, events, request)
+        return f"<tr> {week} </tr>"
+
+    def render_month(self, events, request, withyear=True):
+        cal = f'<table border="0" cellpadding="0" cellspacing="0" class="calendar">\n'
+        cal += f"{self.formatmonthname(self.year, self.month, withyear=withyear)}\n"
+        cal += f"{self.formatweekheader()}\n"
+        for week in self.monthdays2calendar(self.year, self.month):
+            cal += f"{self.formatweek(week, events, request)}\n"
+        return cal
+
+
+# an anonymous request, with nothing checked off, so rendering never touches the database
+class BenchmarkRequest:
+    class User:
+        id = None
+
+    def __init__(self):
+        self.user = self.User()
+        self.checked_assignments = set()
+
+
+# compares rendering a month grid before and after bucketing events by day
+class Command(BaseCommand):
+    help = "Compares event parse counts and render time of the month grid before and after day bucketing"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--events", type=int, default=500)
+        parser.add_argument("--year", type=int, default=datetime.date.today().year)
+        parser.add_argument("--month", type=int, default=datetime.date.today().month)
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        year, month = options["year"], options["month"]
+        days = [
+            day for day, weekday in Calendar().itermonthdays2(year, month) if day != 0
+        ]
+        events = []
+        for i in range(options["events"]):
+            end = datetime.datetime(year, month, random.choice(days), 23, 59)
+            events.append(
+                {
+                    "id": str(i),
+                    "summary": f"assignment {i}",
+                    "description": None,
+                    "className": None,
+                    "end": {"dateTime": end.isoformat()},
+                }
+            )
+
+        parse_datetime = event_module.parse_datetime
+        parsed = [0]
+
+        def counting_parse_datetime(value):
+            parsed[0] += 1
+            return parse_datetime(value)
+
+        event_module.parse_datetime = counting_parse_datetime
+        try:
+            for name, calendar in (
+                ("before", LegacyCalendar(year, month)),
+                ("after", Calendar(year, month)),
+            ):
+                timings = []
+                for _ in range(options["repeat"]):
+                    parsed[0] = 0
+                    start = time.perf_counter()
+                    calendar.render_month(events, BenchmarkRequest())
+                    timings.append(time.perf_counter() - start)
+                self.stdout.write(
+                    f"{name:>6}: {len(events)} events, {parsed[0]:6d} parses, "
+                    f"best {min(timings) * 1000:8.1f} ms, mean {sum(timings) / len(timings) * 1000:8.1f} ms"
+                )
+        finally:
+            event_module.parse_datetime = parse_datetime
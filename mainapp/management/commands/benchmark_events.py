@@ -0,0 +1,124 @@
+import datetime
+import json
+import random
+import time
+import tracemalloc
+from django.core.management.base import BaseCommand
+from mainapp import event as event_module, tools
+from mainapp.event import Event
+from mainapp.timeline import Timeline
+
+
+def google_event(i, end):
+    """
+    Creates an event shaped like the ones the calendar api returns
+    """
+    return {
+        "kind": "calendar#event",
+        "etag": f'"{3000000000000000 + i}"',
+        "id": f"event{i:06d}",
+        "status": "confirmed",
+        "htmlLink": f"https://www.google.com/calendar/event?eid=event{i:06d}",
+        "created": "2022-01-01T00:00:00.000Z",
+        "updated": "2022-01-01T00:00:00.000Z",
+        "summary": f"assignment {i}",
+        "description": "CS 3240",
+        "creator": {"email": "professor@group.calendar.google.com"},
+        "organizer": {"email": "professor@group.calendar.google.com", "self": True},
+        "start": {"dateTime": (end - datetime.timedelta(hours=1)).isoformat()},
+        "end": {"dateTime": end.isoformat()},
+        "iCalUID": f"event{i:06d}@google.com",
+        "sequence": 0,
+        "reminders": {"useDefault": True},
+        "eventType": "default",
+        "className": "CS 3240",
+    }
+
+
+def retained_bytes(build):
+    """
+    Returns what build() returns, and the number of bytes it still holds on to
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    built = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return built, after - before
+
+
+# compares raw event dictionaries against parsed Events, in memory and in the work the todo list does with them
+class Command(BaseCommand):
+    help = "Compares memory per event and end date parses of the todo list for raw event dictionaries and Events"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--events", type=int, default=1000)
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        payload = json.dumps(
+            [
+                google_event(i, now + datetime.timedelta(hours=random.randint(-500, 500)))
+                for i in range(options["events"])
+            ]
+        )
+
+        raw_events, raw_bytes = retained_bytes(lambda: json.loads(payload))
+        events, event_bytes = retained_bytes(
+            lambda: [Event.from_google(event) for event in raw_events]
+        )
+        count = len(raw_events)
+        self.stdout.write(
+            f"   dicts: {raw_bytes / count:8.0f} bytes per event\n"
+            f"  Events: {event_bytes / count:8.0f} bytes per event"
+        )
+
+        parse_datetime = event_module.parse_datetime
+        parsed = [0]
+
+        def counting_parse_datetime(value):
+            parsed[0] += 1
+            return parse_datetime(value)
+
+        # the sorting, splitting and due dates of tools.todo_list, before Events and with Events on a Timeline
+        def before():
+            events = sorted(
+                raw_events,
+                key=lambda event: event_module.parse_datetime(event["end"]["dateTime"]),
+            )
+            past = [
+                event for event in events
+                if tools.num_days_until(event_module.parse_datetime(event["end"]["dateTime"])) < 0
+            ]
+            future = [
+                event for event in events
+                if tools.num_days_until(event_module.parse_datetime(event["end"]["dateTime"])) >= 0
+            ]
+            return [
+                tools.days_until_string(event_module.parse_datetime(event["end"]["dateTime"]))
+                for event in future + past
+            ]
+
+        def after():
+            events = Timeline(map(Event.from_google, raw_events))
+            return [
+                tools.days_until_string(event.end, events.now)
+                for event in events.future() + events.past()
+            ]
+
+        event_module.parse_datetime = counting_parse_datetime
+        try:
+            for name, render in (("before", before), ("after", after)):
+                timings = []
+                for _ in range(options["repeat"]):
+                    parsed[0] = 0
+                    start = time.perf_counter()
+                    render()
+                    timings.append(time.perf_counter() - start)
+                self.stdout.write(
+                    f"{name:>8}: {count} events, {parsed[0]:6d} parses, "
+                    f"best {min(timings) * 1000:8.1f} ms, mean {sum(timings) / len(timings) * 1000:8.1f} ms"
+                )
+        finally:
+            event_module.parse_datetime = parse_datetime
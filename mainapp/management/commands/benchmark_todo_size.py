@@ -0,0 +1,74 @@
+import datetime
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from mainapp import tools
+from mainapp.event import Event
+
+
+def inline_assignment_html(request, events, className=None, editable=False):
+    """
+    The assignment markup before the per-student stylesheet, with the colors and layout inlined on every event
+    """
+    ret = ""
+    for event in events:
+        checked = tools.is_checked_off(request, event)
+        ret += f"""<div class="container">
+        <div class="container" style="{"" if not checked else "text-decoration: line-through;"} border-radius:1.5vh; background-color:{tools.get_color(request, event.description)};
+        font-size:1.2vw; color:{"white" if not checked else "gray"}; padding-left:5%; margin-bottom: 10px;">
+        <div class="item" style="width:30%;overflow-wrap: break-word;">{event.summary}</div>"""
+        if className == None:
+            ret += f"""
+            <div style="text-align:center;overflow-wrap: break-word;" class="item">{event.description if str(event.description) != "None" else "Personal"}</div>"""
+        ret += f"""
+        <div class="item" style="padding-right:5%;width:30%;text-align:right;overflow-wrap: break-word;">{tools.days_until_string(event.end)}</div>
+        """
+        ret += "</div>"
+        if editable:
+            ret += f"""<a href="{event.className}/{event.id}/delete_assignment/check/">
+            """
+            ret += f"""<button style="right:-20%; border-radius:80px;color:white;
+            background-color:green; border:none;width:20%;font-size:1.2vw;position:absolute;"><i class='bx bx-{'check-' if checked else ''}square'></i> Check Off</button></a>"""
+        ret += "</div>"
+    return ret
+
+
+class BenchmarkRequest:
+    """
+    A request from a signed out user, so rendering never touches the database
+    """
+
+    def __init__(self):
+        self.user = AnonymousUser()
+        self.student = None
+        self.checked_assignments = set()
+
+
+# compares the size of a todo page with inline styles against the markup that names classes of the student stylesheet
+class Command(BaseCommand):
+    help = "Compares the bytes of a todo page rendered with inline styles and with the per-student stylesheet"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--assignments", type=int, default=200)
+        parser.add_argument("--classes", type=int, default=5)
+
+    def handle(self, *args, **options):
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        events = [
+            Event(
+                id=f"event{i:06d}",
+                summary=f"assignment {i}",
+                description=f"CS {3000 + i % options['classes']}",
+                className=f"CS {3000 + i % options['classes']}",
+                end=now + datetime.timedelta(hours=i),
+            )
+            for i in range(options["assignments"])
+        ]
+        request = BenchmarkRequest()
+
+        before = len(inline_assignment_html(request, events, editable=True).encode())
+        after = len(tools.assignment_html(request, events, editable=True).encode())
+        self.stdout.write(
+            f"  before: {before:8d} bytes, {before / len(events):6.0f} bytes per assignment\n"
+            f"   after: {after:8d} bytes, {after / len(events):6.0f} bytes per assignment\n"
+            f"   saved: {1 - after / before:8.1%}"
+        )
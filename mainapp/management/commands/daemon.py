@@ -1,16 +1,47 @@
 from mainapp import services
+from django.conf import settings
 from django_daemon_command.management.base import DaemonCommand
 
 # this class initializes the email service alone for a separate daemon
+# several daemon dynos can split the daily digest, for example with 2 dynos:
+#   python manage.py daemon --digest-shards 2 --digest-shard 0
+#   python manage.py daemon --digest-shards 2 --digest-shard 1
 class Command(DaemonCommand):
 
     initialized = False
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            "--digest-workers", type=int, default=settings.DIGEST_WORKERS,
+            help="Number of worker processes running the daily digest of this dyno",
+        )
+        parser.add_argument(
+            "--digest-shard", type=int, default=settings.DIGEST_SHARD,
+            help="Shard of the students (from 0) this dyno sends the daily digest to",
+        )
+        parser.add_argument(
+            "--digest-shards", type=int, default=settings.DIGEST_SHARDS,
+            help="Number of dynos splitting the daily digest",
+        )
+        parser.add_argument(
+            "--digest-strategy", choices=["hash", "range"], default=settings.DIGEST_SHARD_STRATEGY,
+            help="Splits students by hash or by range of their id",
+        )
+
     def process(self, *args, **options):
         '''
         Initializes email service for Heroku Daemon
         '''
         if not self.initialized:
             print("Initializing dyno services...")
-            services.initialize_services_for_daemon()
+            services.initialize_services_for_daemon(
+                {
+                    "workers": options["digest_workers"],
+                    "shard": options["digest_shard"],
+                    "shards": options["digest_shards"],
+                    "strategy": options["digest_strategy"],
+                }
+            )
             print("Services initialized")
-            self.initialized = True
\ No newline at end of file
+            self.initialized = True
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from mainapp import models
+
+# converts the pickled Student.classes / Student.class_colors of existing students into Enrollment rows
+class Command(BaseCommand):
+    help = "Creates Enrollment rows from the legacy pickled classes and class colors of every student"
+
+    def handle(self, *args, **options):
+        classes = {clazz.pk: clazz for clazz in models.Class.objects.all()}
+        by_name = {clazz.className: clazz for clazz in classes.values()}
+        created = 0
+        skipped = 0
+
+        with transaction.atomic():
+            for student in models.Student.objects.defer(None).iterator():
+                enrolled = set(
+                    models.Enrollment.objects.filter(student=student).values_list(
+                        "clazz_id", flat=True
+                    )
+                )
+                colors = {
+                    self.current_class(clazz, classes, by_name): color
+                    for clazz, color in (student.legacy_class_colors or {}).items()
+                }
+                enrollments = []
+                for pickled in student.legacy_classes or set():
+                    clazz = self.current_class(pickled, classes, by_name)
+                    # the class was deleted since it was pickled
+                    if clazz == None:
+                        skipped += 1
+                        continue
+                    if clazz.pk in enrolled:
+                        continue
+                    enrolled.add(clazz.pk)
+                    enrollments.append(
+                        models.Enrollment(
+                            student=student,
+                            clazz=clazz,
+                            color=colors.get(clazz, models.DEFAULT_CLASS_COLOR),
+                        )
+                    )
+                models.Enrollment.objects.bulk_create(enrollments)
+                created += len(enrollments)
+
+        self.stdout.write(
+            f"Created {created} enrollments, skipped {skipped} classes that no longer exist"
+        )
+
+    def current_class(self, pickled, classes, by_name):
+        """
+        Returns the current Class row for a pickled class, matched by id and then by name
+        """
+        if pickled == None:
+            return None
+        if pickled.pk in classes:
+            return classes[pickled.pk]
+        return by_name.get(pickled.className)
@@ -0,0 +1,33 @@
+from . import tools
+
+
+class StudentMiddleware:
+    """
+    Loads the student of the logged in user once per request, and attaches it as request.student
+    Every helper in tools reads the student from there (see tools.get_student)
+    Must come after django's AuthenticationMiddleware, which sets request.user
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.student = tools.load_student(request)
+        return self.get_response(request)
+
+
+class CurrentClassMiddleware:
+    """
+    Resolves the class of the page being requested once, from the className the url was routed with,
+    and attaches it as request.current_class (None for pages that do not belong to a class)
+    Every helper in tools reads the class from there (see tools.current_class)
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.current_class = tools.load_current_class(request)
@@ -4,24 +4,184 @@ import django_filters
 
 # Create your models here.
 
+DEFAULT_CLASS_COLOR = "#0052bd"
+
+
+class StudentManager(models.Manager):
+    def get_queryset(self):
+        # the legacy pickles are never unpickled, unless a query asks for them with defer(None)
+        return super().get_queryset().defer("legacy_classes", "legacy_class_colors")
+
 
 class Student(models.Model):
     """
     Student model. Allows mapping from internal user.id to google calendar api calendarIds.
     Professors are also counted as students, so they also get their own calendar
+    The classes of a student (and their colors) are stored as Enrollment rows, see the classes property
     """
 
     userId = models.IntegerField()
     calendarId = models.CharField(max_length=200)
-    # pickled representation of python set of classNames
-    classes = PickledObjectField()
-    class_colors = PickledObjectField()
+    # pickled set of classes and dict of class colors from before Enrollment existed.
+    # only read by the migrate_enrollments command
+    legacy_classes = PickledObjectField(db_column="classes", default=set)
+    legacy_class_colors = PickledObjectField(db_column="class_colors", default=dict)
     color = models.CharField(default="#0052bd", max_length=10)
     professor = models.BooleanField(default=False)
     name = models.CharField(max_length=50, null=True)
     description = models.CharField(max_length=10000, null=True)
     mood = models.CharField(max_length=50, null=True)
     profile_photo = models.FileField(upload_to="files/profiles/", null=True)
+    # bumped every time the colors of this student change, so browsers refetch their stylesheet
+    color_version = models.IntegerField(default=0)
+    # bumped every time this student checks off an assignment, so their cached todo list is rendered again
+    checked_version = models.IntegerField(default=0)
+
+    objects = StudentManager()
+
+    @property
+    def classes(self):
+        """
+        Set of classes this student is enrolled in. Loaded once per instance, with the class colors
+        Assigning a set of classes replaces the enrollments when the student is saved
+        """
+        self.load_enrollments()
+        return set(self._class_colors)
+
+    @classes.setter
+    def classes(self, classes):
+        self.load_enrollments()
+        self._class_colors = {
+            clazz: self._pending_colors.get(
+                clazz, self._class_colors.get(clazz, DEFAULT_CLASS_COLOR)
+            )
+            for clazz in classes
+        }
+        self._enrollments_changed = True
+
+    @property
+    def class_colors(self):
+        """
+        Dictionary from each class this student is enrolled in to its color
+        Assigning a dictionary recolors the enrolled classes when the student is saved
+        """
+        self.load_enrollments()
+        return dict(self._class_colors)
+
+    @class_colors.setter
+    def class_colors(self, class_colors):
+        self.load_enrollments()
+        self._class_colors.update(
+            (clazz, color) for clazz, color in class_colors.items() if clazz in self._class_colors
+        )
+        self._pending_colors = dict(class_colors)
+        self._enrollments_changed = True
+
+    def load_enrollments(self):
+        """
+        Loads the enrollments of this student, unless they are already loaded
+        """
+        if vars(self).get("_class_colors") != None:
+            return
+        self._pending_colors = {}
+        self._enrollments_changed = False
+        if self.pk == None:
+            self._class_colors = {}
+            return
+        self._class_colors = {
+            enrollment.clazz: enrollment.color
+            for enrollment in Enrollment.objects.filter(student=self).select_related("clazz")
+        }
+
+    def enroll(self, clazz, color=DEFAULT_CLASS_COLOR):
+        """
+        Enrolls this student in clazz, or recolors clazz if they already are enrolled
+        """
+        Enrollment.objects.update_or_create(student=self, clazz=clazz, defaults={"color": color})
+        if vars(self).get("_class_colors") != None:
+            self._class_colors[clazz] = color
+        self.colors_changed()
+
+    def unenroll(self, clazz):
+        """
+        Removes this student from clazz
+        """
+        Enrollment.objects.filter(student=self, clazz=clazz).delete()
+        if vars(self).get("_class_colors") != None:
+            self._class_colors.pop(clazz, None)
+        self.colors_changed()
+
+    def set_class_color(self, clazz, color):
+        """
+        Changes the color of clazz for this student, if they are enrolled in it
+        """
+        Enrollment.objects.filter(student=self, clazz=clazz).update(color=color)
+        if vars(self).get("_class_colors") != None and clazz in self._class_colors:
+            self._class_colors[clazz] = color
+        self.colors_changed()
+
+    def colors_changed(self):
+        """
+        Bumps color_version, after the color of this student or of one of their classes changed
+        """
+        Student.objects.filter(pk=self.pk).update(color_version=models.F("color_version") + 1)
+        self.color_version += 1
+
+    def checkmarks_changed(self):
+        """
+        Bumps checked_version, after this student checked off an assignment or unchecked one
+        """
+        Student.objects.filter(pk=self.pk).update(checked_version=models.F("checked_version") + 1)
+        self.checked_version += 1
+
+    # only ever bumped with F() updates, so saving an older copy of a student cannot put them back
+    counter_fields = ["color_version", "checked_version"]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get("update_fields") == None and not kwargs.get("force_insert"):
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.counter_fields
+            ]
+        super().save(*args, **kwargs)
+        if vars(self).get("_enrollments_changed"):
+            self.save_enrollments()
+
+    def save_enrollments(self):
+        """
+        Writes the classes and class colors assigned to this student to its Enrollment rows
+        """
+        colors = {
+            clazz: self._pending_colors.get(clazz, color)
+            for clazz, color in self._class_colors.items()
+        }
+        existing = {
+            enrollment.clazz_id: enrollment
+            for enrollment in Enrollment.objects.filter(student=self)
+        }
+        removed, _ = Enrollment.objects.filter(student=self).exclude(
+            clazz__in=[clazz.pk for clazz in colors]
+        ).delete()
+        added = Enrollment.objects.bulk_create(
+            [
+                Enrollment(student=self, clazz=clazz, color=color)
+                for clazz, color in colors.items()
+                if clazz.pk not in existing
+            ]
+        )
+        recolored = [
+            clazz
+            for clazz, color in colors.items()
+            if clazz.pk in existing and existing[clazz.pk].color != color
+        ]
+        for clazz in recolored:
+            Enrollment.objects.filter(pk=existing[clazz.pk].pk).update(color=colors[clazz])
+        self._class_colors = colors
+        self._pending_colors = {}
+        self._enrollments_changed = False
+        if removed or added or recolored:
+            self.colors_changed()
 
 
 class Class(models.Model):
@@ -40,6 +200,21 @@ class Class(models.Model):
         return self.className
 
 
+class Enrollment(models.Model):
+    """
+    A student taking a class, with the color the student picked for that class
+    Indexed both ways, for the classes of a student and the students of a class (rosters)
+    """
+
+    student = models.ForeignKey(Student, on_delete=models.CASCADE, related_name="enrollments")
+    clazz = models.ForeignKey(Class, on_delete=models.CASCADE, related_name="enrollments")
+    color = models.CharField(default=DEFAULT_CLASS_COLOR, max_length=10)
+
+    class Meta:
+        unique_together = [("student", "clazz")]
+        indexes = [models.Index(fields=["clazz", "student"])]
+
+
 class File(models.Model):
     className = models.CharField(max_length=255, blank=True)
 
@@ -75,6 +250,18 @@ class Notification(models.Model):
     text = models.CharField(max_length=500)
 
 
+class ClassChange(models.Model):
+    """
+    An assignment change in a class, stored once however many students take the class
+    Expanded into an email for every student of the class when messages are sent (see tools.send_all_messages)
+    """
+
+    className = models.CharField(max_length=50)
+    assignmentName = models.CharField(max_length=200)
+    action = models.CharField(max_length=20)
+    created = models.DateTimeField(auto_now_add=True)
+
+
 class CheckedAssignments(models.Model):
     """
     Maintains assignments that are checked off
@@ -83,3 +270,43 @@ class CheckedAssignments(models.Model):
     userId = models.IntegerField()
     className = models.CharField(max_length=50)
     eventId = models.CharField(max_length=200)
+
+    class Meta:
+        indexes = [models.Index(fields=["userId", "className", "eventId"])]
+
+
+class CalendarSync(models.Model):
+    """
+    Sync state for a google calendar that is mirrored locally (see event_mirror).
+    syncToken is the token returned by google at the end of the last sync, and is used to
+    only pull changes on the next sync. synced_at is None when the mirror has been marked stale
+    version changes every time the mirrored events of the calendar change (see event_cache)
+    """
+
+    calendarId = models.CharField(max_length=200, unique=True)
+    syncToken = models.CharField(max_length=500, blank=True, default="")
+    synced_at = models.DateTimeField(null=True)
+    version = models.CharField(max_length=32, blank=True, default="")
+
+
+class MirroredEvent(models.Model):
+    """
+    Local copy of a google calendar event. body is the event exactly as returned by the calendar api
+    """
+
+    calendarId = models.CharField(max_length=200)
+    eventId = models.CharField(max_length=1024)
+    end = models.DateTimeField(null=True)
+    body = PickledObjectField()
+
+    class Meta:
+        # a calendar holds each event once, so concurrent syncs cannot store it twice
+        # events without an id (which google always sets) cannot be told apart, and are left out
+        constraints = [
+            models.UniqueConstraint(
+                fields=["calendarId", "eventId"],
+                condition=~models.Q(eventId=""),
+                name="unique_mirrored_event",
+            )
+        ]
+        indexes = [models.Index(fields=["calendarId", "end"])]
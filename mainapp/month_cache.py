@@ -0,0 +1,152 @@
+import concurrent.futures
+import hashlib
+import threading
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from . import tools
+
+# Rendered month grids of the calendar page are cached per student and month. Entries are keyed on the
+# versions of everything a month shows (see month_key), so they are never read once the student's events,
+# checkmarks or colors change. After a month is served, the months before and after it are rendered on a
+# background thread (see prefetch_adjacent), so paging through the calendar is served from the cache.
+
+
+def month_cache():
+    """
+    Returns the django cache holding rendered months
+    """
+    return caches[settings.MONTH_CACHE_ALIAS]
+
+
+def month_key(request, year, month, withyear=True):
+    """
+    Returns the cache key of a month of the calendar of the student of this request, or None if it cannot be cached
+    The key holds the sync version of every calendar of the student (see tools.calendar_versions), and
+    their checked_version and color_version
+    """
+    if settings.MONTH_CACHE_TTL <= 0 or request == None or not tools.student_exists(request):
+        return None
+    versions = tools.calendar_versions(request)
+    if versions == None:
+        return None
+    student = tools.get_student(request)
+    parts = repr(
+        (year, month, withyear, versions, student.checked_version, student.color_version)
+    )
+    return f"month:{student.userId}:{hashlib.sha1(parts.encode()).hexdigest()}"
+
+
+def cached_month(key):
+    """
+    Returns the rendered month cached under key, or None
+    """
+    if key == None:
+        return None
+    return month_cache().get(key)
+
+
+def cache_month(key, html):
+    """
+    Caches a rendered month under key
+    """
+    if key != None:
+        month_cache().set(key, html, timeout=settings.MONTH_CACHE_TTL)
+
+
+def adjacent_months(year, month):
+    """
+    Returns the (year, month) pairs of the months before and after a month
+    """
+    before = (year - 1, 12) if month == 1 else (year, month - 1)
+    after = (year + 1, 1) if month == 12 else (year, month + 1)
+    return [before, after]
+
+
+def prefetch_adjacent(request, year, month, withyear=True):
+    """
+    Renders the months before and after a month into the cache, unless they already are cached
+    Months are rendered on a background thread when settings.MONTH_PREFETCH is "thread", in this thread
+    when it is "inline", and not at all when it is "off"
+    """
+    if settings.MONTH_PREFETCH == "off":
+        return
+    for adjacent_year, adjacent_month in adjacent_months(year, month):
+        # the versions were looked up for this request's month, so this does not query anything
+        key = month_key(request, adjacent_year, adjacent_month, withyear)
+        if key == None or cached_month(key) != None:
+            continue
+        if settings.MONTH_PREFETCH == "inline":
+            warm(request.user.id, adjacent_year, adjacent_month, withyear)
+            continue
+        with pending_lock:
+            if key in pending:
+                continue
+            pending.add(key)
+        get_prefetch_executor().submit(
+            warm_in_background, key, request.user.id, adjacent_year, adjacent_month, withyear
+        )
+
+
+# shared by every request, so prefetching runs on at most settings.MONTH_PREFETCH_THREADS threads
+prefetch_executor = None
+# the keys of the months queued on prefetch_executor, so a month is only queued once
+pending = set()
+pending_lock = threading.Lock()
+
+
+def get_prefetch_executor():
+    """
+    Returns the thread pool rendering months in the background, creating it on first use
+    """
+    global prefetch_executor
+    if prefetch_executor == None:
+        prefetch_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=settings.MONTH_PREFETCH_THREADS,
+            thread_name_prefix="month-prefetch",
+        )
+    return prefetch_executor
+
+
+def warm_in_background(key, userId, year, month, withyear=True):
+    """
+    Runs warm on a prefetch thread, which has its own database connection that is closed when it is done
+    """
+    try:
+        warm(userId, year, month, withyear)
+    except Exception as e:
+        print("Failed to prefetch month", year, month, "for user", userId, e)
+    finally:
+        with pending_lock:
+            pending.discard(key)
+        connection.close()
+
+
+def warm(userId, year, month, withyear=True):
+    """
+    Renders a month of the calendar of the student with userId into the cache
+    """
+    from .calendar_generator import Calendar
+
+    request = PrefetchRequest(userId)
+    key = month_key(request, year, month, withyear)
+    if key == None or cached_month(key) != None:
+        return
+    # month_key refreshed every calendar of the student, and none of them failed
+    events = tools.get_events_from_calendar_all_classes(
+        tools.get_student(request), month=month, year=year, failures={}
+    )
+    cache_month(key, Calendar(year, month).render_month(events, request, withyear=withyear))
+
+
+class PrefetchRequest:
+    """
+    Stands in for the request of a student when a month is rendered outside of a request
+    """
+
+    class User:
+        def __init__(self, id):
+            self.id = id
+
+    def __init__(self, userId):
+        self.user = PrefetchRequest.User(userId)
@@ -1,14 +1,16 @@
 import os
 from google.oauth2 import service_account
 import sys
+import threading
 from googleapiclient.discovery import build
 from .email_service import EmailService
 
 # structure of this method was replicated from https://cloud.google.com/iam/docs/creating-managing-service-accounts
-def initialize_google_calendar_service():
+def initialize_google_calendar_service(timeout=None):
     """
     Initializes the google calendar service
     Requires the placement of client_secret.json in the root directory of project
+    If timeout is given, every http request of this service gives up after timeout seconds
     """
     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "client_secret.json"
 
@@ -17,14 +19,46 @@ def initialize_google_calendar_service():
         scopes=["https://www.googleapis.com/auth/calendar.app.created"],
     )
 
+    if timeout != None:
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+
+        return build(
+            "calendar",
+            "v3",
+            http=AuthorizedHttp(credentials, http=httplib2.Http(timeout=timeout)),
+        )
     return build("calendar", "v3", credentials=credentials)
 
 
-def initialize_email_service():
+thread_services = threading.local()
+
+
+def get_calendar_service():
+    """
+    Returns the google calendar service to use on the current thread
+    httplib2 (used by the google api client) is not thread-safe, so every thread other than the main
+    thread lazily gets its own service instance. The fake service for tests is shared by every thread
+    """
+    if isinstance(calendar_service, FakeCalendarService):
+        return calendar_service
+    if threading.current_thread() is threading.main_thread():
+        return calendar_service
+    if not hasattr(thread_services, "calendar_service"):
+        from django.conf import settings
+
+        thread_services.calendar_service = initialize_google_calendar_service(
+            timeout=settings.CALENDAR_FETCH_DEADLINE
+        )
+    return thread_services.calendar_service
+
+
+def initialize_email_service(digest_options=None):
     """
     Initializes the email service
+    digest_options are the arguments of the daily digest job (see tools.notify_students_of_today_assignments)
     """
-    return EmailService()
+    return EmailService(digest_options)
 
 
 class FakeExecutor:
@@ -36,12 +70,38 @@ class FakeEventResult:
     def list(*args, **kwargs):
         return FakeExecutor()
 
+    def insert(*args, **kwargs):
+        return FakeExecutor()
+
+    def delete(*args, **kwargs):
+        return FakeExecutor()
+
 
 class FakeCalendarResult:
     def insert(*args, **kwargs):
         return FakeExecutor()
 
 
+class FakeBatchRequest:
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request, request_id))
+
+    def execute(self, *args, **kwargs):
+        from googleapiclient.errors import HttpError
+
+        for request, request_id in self.requests:
+            try:
+                response = request.execute()
+            except HttpError as e:
+                self.callback(request_id, None, e)
+            else:
+                self.callback(request_id, response, None)
+
+
 class FakeCalendarService:
     def events(*args, **kwargs):
         return FakeEventResult()
@@ -49,6 +109,9 @@ class FakeCalendarService:
     def calendars(*args, **kwargs):
         return FakeCalendarResult()
 
+    def new_batch_http_request(self, callback=None):
+        return FakeBatchRequest(callback)
+
 
 def initialize_services():
     """
@@ -69,9 +132,19 @@ def initialize_services():
     print("Using parameters: " + str(sys.argv))
 
 
-def initialize_services_for_daemon():
+def initialize_services_for_daemon(digest_options=None):
     """
     Initializes the services for the seperate daemon
     """
     global email_service
-    email_service = initialize_email_service()
+    email_service = initialize_email_service(digest_options)
+
+
+def initialize_services_for_worker():
+    """
+    Initializes the services of a worker process of the daily digest (see digest.initialize_worker)
+    The calendar service of the parent process is not shared with forked processes
+    """
+    global calendar_service
+    if not isinstance(calendar_service, FakeCalendarService):
+        calendar_service = initialize_google_calendar_service()
@@ -4,10 +4,14 @@ from django.test import TestCase
 from django.contrib.auth.models import User
 from mockito import when, mock, any
 from .test_utils import *
-from . import tools, services, views, models, test_utils, context_processors
+from . import tools, services, views, models, test_utils, context_processors, event_mirror, calendar_api, event_cache, month_cache, digest
 from .calendar_generator import Calendar
+from .event import Event
+from .timeline import Timeline
 from django.urls import reverse
 import builtins
+import os
+import re
 
 # Create your tests here.
 google_calendar_service_events_copy = services.calendar_service.events
@@ -253,13 +257,13 @@ class ViewTests(TestCase):
                     "calendar": "class name",
                 },
             )
-            self.assertTrue(0 != models.Notification.objects.all().count())
+            self.assertTrue(0 != models.ClassChange.objects.all().count())
         finally:
             # we passed
             unstub()
             logout(self, user)
             models.Student.objects.all().delete()
-            models.Notification.objects.all().delete()
+            models.ClassChange.objects.all().delete()
             models.Class.objects.all().delete()
             return
 
@@ -1274,13 +1278,94 @@ class TestTools(TestCase):
 
         tools.notify_students_of_change("New class", "Assg", "change")
         try:
-            self.assertTrue(models.Notification.objects.all().count() == 1)
+            self.assertTrue(models.ClassChange.objects.all().count() == 1)
         finally:
             models.Student.objects.all().delete()
             models.Class.objects.all().delete()
-            models.Notification.objects.all().delete()
+            models.ClassChange.objects.all().delete()
             test_utils.logout(self, user, destroy_student=False)
 
+    def test_send_all_messages_class_changes(self):
+        """
+        Tests that a class change is stored once, and emailed to every student of the class when messages are sent
+        """
+        clazz = models.Class.objects.create(calendarId=1020, className="New class", professorId=0)
+        for i in range(5):
+            user = User.objects.create(username=f"user{i}", email=f"user{i}@test.com")
+            models.Student.objects.create(userId=user.id, calendarId=i, name=f"user {i}").enroll(clazz)
+        # a student whose user is gone is skipped
+        models.Student.objects.create(userId=1234, calendarId=5, name="gone").enroll(clazz)
+        models.Student.objects.create(userId=4321, calendarId=6, name="other class")
+
+        with self.assertNumQueries(1):
+            tools.notify_students_of_change("New class", "Assg", "change")
+        self.assertEquals(1, models.ClassChange.objects.count())
+        self.assertEquals(0, models.Notification.objects.count())
+
+        sent = {}
+
+        class Mocked_Email_Service:
+            def message(self, text, to, subject):
+                sent[to] = text
+
+        temp_email_service = getattr(services, "email_service", None)
+        services.email_service = Mocked_Email_Service()
+        try:
+            with self.settings(NOTIFICATION_BATCH_SIZE=2, NOTIFICATION_COALESCE_WINDOW=0):
+                tools.send_all_messages()
+        finally:
+            services.email_service = temp_email_service
+
+        self.assertEquals([f"user{i}@test.com" for i in range(5)], sorted(sent))
+        self.assertTrue("Dear user 3," in sent["user3@test.com"])
+        self.assertTrue("Assignment 'Assg' was changed for class 'New class'." in sent["user3@test.com"])
+        self.assertEquals(0, models.ClassChange.objects.count())
+
+    def test_send_all_messages_coalesced(self):
+        """
+        Tests that all the messages pending for a student are sent as one email, and that recent changes wait
+        """
+        classes = [
+            models.Class.objects.create(calendarId=i, className=f"class {i}", professorId=0) for i in range(2)
+        ]
+        for i in range(2):
+            user = User.objects.create(username=f"user{i}", email=f"user{i}@test.com")
+            student = models.Student.objects.create(userId=user.id, calendarId=i, name=f"user {i}")
+            for clazz in classes[: i + 1]:
+                student.enroll(clazz)
+        for line in range(3):
+            tools.notify_students_of_change("class 1", f"Syllabus {line}", "create")
+        tools.notify_students_of_change("class 0", "Homework", "change")
+        tools.send_message(User.objects.get(username="user1").id, "Daily digest")
+
+        sent = []
+
+        class Mocked_Email_Service:
+            def message(self, text, to, subject):
+                sent.append((to, text))
+
+        temp_email_service = getattr(services, "email_service", None)
+        services.email_service = Mocked_Email_Service()
+        try:
+            # every change is recent, so only the notification is sent
+            self.assertEquals({"messages": 1, "emails": 1}, tools.send_all_messages())
+            self.assertEquals(4, models.ClassChange.objects.count())
+            with self.settings(NOTIFICATION_COALESCE_WINDOW=0):
+                self.assertEquals({"messages": 5, "emails": 2}, tools.send_all_messages())
+        finally:
+            services.email_service = temp_email_service
+
+        self.assertEquals(("user1@test.com", "Daily digest"), sent[0])
+        emails = dict(sent[1:])
+        self.assertEquals(["user0@test.com", "user1@test.com"], sorted(emails))
+        self.assertTrue("An assignment has been updated" in emails["user0@test.com"])
+        text = emails["user1@test.com"]
+        self.assertTrue(text.startswith("\nDear user 1,"))
+        self.assertTrue("4 assignments have been updated in your classes:" in text)
+        self.assertTrue("Assignment 'Syllabus 2' was created for class 'class 1'." in text)
+        self.assertTrue("Assignment 'Homework' was changed for class 'class 0'." in text)
+        self.assertEquals(0, models.ClassChange.objects.count())
+
     def test_notify_students_of_today_assignments_no_today_assignments(self):
         """
         Tets notify students of today assignments given no assignments for today
@@ -1288,11 +1373,11 @@ class TestTools(TestCase):
         later = datetime.now(tz=pytz.UTC) + timedelta(days=4)
         user = test_utils.login(self, create_student=True)
 
-        when(tools).get_events_from_calendar_all_classes(
+        when(tools).get_events_from_calendar(
             any, day=any, month=any, year=any
         ).thenReturn([])
 
-        when(tools).get_events_from_calendar_all_classes(
+        when(tools).get_events_from_calendar(
             any, day=later.day, month=later.month, year=later.year
         ).thenReturn([create_date(year=later.year, month=later.month, day=later.day)])
 
@@ -1313,11 +1398,11 @@ class TestTools(TestCase):
         # this is to fix the weird date offset
         now = datetime.now(tz=pytz.UTC) - timedelta(days=1)
 
-        when(tools).get_events_from_calendar_all_classes(
+        when(tools).get_events_from_calendar(
             any, day=any, month=any, year=any
         ).thenReturn([])
 
-        when(tools).get_events_from_calendar_all_classes(
+        when(tools).get_events_from_calendar(
             any, day=now.day, month=now.month, year=now.year
         ).thenReturn([create_date(year=now.year, month=now.month, day=now.day)])
 
@@ -2068,8 +2153,11 @@ class TestTools(TestCase):
 
         when(services.calendar_service).events().thenReturn(Placeholder())
 
+        # events come back from the local mirror as copies, tagged with className None
+        tagged_events = [dict(event, className=None) for event in events]
+
         try:
-            self.assertEquals(tools.get_events_from_calendar(calendarId), events)
+            self.assertEquals(tools.get_events_from_calendar(calendarId), tagged_events)
         finally:
             unstub()
 
@@ -2662,4 +2750,1609 @@ class ContextProcessorTests(TestCase):
         finally:
             models.Class.objects.all().delete()
             models.Student.objects.all().delete()
-            logout(self, user, destroy_student=False)
\ No newline at end of file
+            logout(self, user, destroy_student=False)
+
+
+class EventMirrorTests(TestCase):
+
+    def test_get_events_full_sync_once(self):
+        """
+        Tests that reading a fresh mirror twice only queries google once
+        """
+        calls = []
+
+        class NestedPlaceholder:
+            def execute(*args, **kwargs):
+                return {"items": [create_date(name="mirrored event")], "nextSyncToken": "token"}
+
+        class Placeholder:
+            def list(*args, **kwargs):
+                calls.append(kwargs)
+                return NestedPlaceholder()
+
+        when(services.calendar_service).events().thenReturn(Placeholder())
+
+        try:
+            event_mirror.get_events("calendar")
+            events = event_mirror.get_events("calendar")
+            self.assertEquals(1, len(calls))
+            self.assertEquals("mirrored event", events[0]["summary"])
+            self.assertEquals("token", models.CalendarSync.objects.get(calendarId="calendar").syncToken)
+        finally:
+            unstub()
+
+    def test_get_events_incremental_sync(self):
+        """
+        Tests that a stale mirror with a sync token only pulls changes, removing cancelled events
+        """
+        kept = create_date(name="kept event")
+        kept["id"] = "kept"
+        removed = create_date(name="removed event")
+        removed["id"] = "removed"
+        added = create_date(name="added event")
+        added["id"] = "added"
+        calls = []
+
+        class NestedPlaceholder:
+            def __init__(self, items):
+                self.items = items
+
+            def execute(self, *args, **kwargs):
+                return {"items": self.items, "nextSyncToken": "next token"}
+
+        class Placeholder:
+            def list(*args, **kwargs):
+                calls.append(kwargs)
+                if kwargs.get("syncToken") == "token":
+                    return NestedPlaceholder([added, {"id": "removed", "status": "cancelled"}])
+                return NestedPlaceholder([kept, removed])
+
+        when(services.calendar_service).events().thenReturn(Placeholder())
+
+        try:
+            event_mirror.get_events("calendar")
+            models.CalendarSync.objects.filter(calendarId="calendar").update(syncToken="token")
+            event_mirror.mark_stale("calendar")
+
+            events = event_mirror.get_events("calendar")
+            self.assertEquals("token", calls[-1]["syncToken"])
+            self.assertEquals(["kept event", "added event"], [event["summary"] for event in events])
+        finally:
+            unstub()
+
+    def test_sync_stale_state_twice(self):
+        """
+        Tests that a calendar two readers both found stale is only synced by the first, and stored once
+        """
+        event = create_date(name="mirrored event")
+        calls = []
+
+        def pages(calendarId, **kwargs):
+            calls.append(kwargs)
+            return iter([{"items": [event], "nextSyncToken": "token"}])
+
+        first = event_mirror.get_sync_state("calendar")
+        second = event_mirror.get_sync_state("calendar")
+        when(calendar_api).iter_event_pages("calendar").thenAnswer(pages)
+        when(calendar_api).iter_event_pages("calendar", syncToken=any).thenAnswer(pages)
+        try:
+            event_mirror.sync(first)
+            event_mirror.sync(second)
+            self.assertEquals(1, models.MirroredEvent.objects.filter(calendarId="calendar").count())
+            self.assertEquals(first.version, second.version)
+            self.assertEquals("token", second.syncToken)
+
+            # incremental syncs and writes of the same event update the single stored copy
+            event_mirror.apply_changes("calendar", [event, event])
+            event_mirror.save_event("calendar", event)
+            self.assertEquals(1, models.MirroredEvent.objects.filter(calendarId="calendar").count())
+        finally:
+            unstub()
+
+    def test_get_events_expired_sync_token(self):
+        """
+        Tests that an expired sync token (410 GONE) falls back to a full sync
+        """
+        from googleapiclient.errors import HttpError
+        import httplib2
+
+        class NestedPlaceholder:
+            def __init__(self, sync_token):
+                self.sync_token = sync_token
+
+            def execute(self, *args, **kwargs):
+                if self.sync_token != None:
+                    raise HttpError(httplib2.Response({"status": 410}), b"")
+                return {"items": [create_date(name="resynced event")]}
+
+        class Placeholder:
+            def list(*args, **kwargs):
+                return NestedPlaceholder(kwargs.get("syncToken"))
+
+        when(services.calendar_service).events().thenReturn(Placeholder())
+        models.CalendarSync.objects.create(calendarId="calendar", syncToken="expired")
+
+        try:
+            events = event_mirror.get_events("calendar")
+            self.assertEquals(["resynced event"], [event["summary"] for event in events])
+            self.assertEquals("", models.CalendarSync.objects.get(calendarId="calendar").syncToken)
+        finally:
+            unstub()
+
+    def test_write_through_keeps_sync(self):
+        """
+        Tests that writing an event to the mirror does not undo a sync that finished since the state was read
+        """
+        from django.utils import timezone
+
+        # read before the sync finished
+        state = event_mirror.get_sync_state("calendar")
+        synced_at = timezone.now()
+        models.CalendarSync.objects.filter(calendarId="calendar").update(syncToken="token", synced_at=synced_at)
+        when(event_mirror).get_sync_state("calendar").thenReturn(state)
+        try:
+            event_mirror.save_event("calendar", create_date(name="saved event"))
+            event_mirror.remove_event("calendar", "1234")
+        finally:
+            unstub()
+        saved = models.CalendarSync.objects.get(calendarId="calendar")
+        self.assertEquals("token", saved.syncToken)
+        self.assertEquals(synced_at, saved.synced_at)
+        self.assertEquals(state.version, saved.version)
+
+    def test_create_event_marks_mirror_stale(self):
+        """
+        Tests that creating an event forces the next read of that calendar to sync
+        """
+        user = login(self, create_student=False)
+        models.Student.objects.create(
+            userId=user.id,
+            calendarId="calendar",
+            classes=set(),
+            class_colors=dict(),
+            color="#000000",
+        )
+        request = create_request(user.id)
+        event_mirror.get_events("calendar")
+
+        try:
+            tools.create_event(request, "summary", datetime(2000, 1, 1), isPersonal=True)
+            self.assertTrue(event_mirror.is_stale(event_mirror.get_sync_state("calendar")))
+        finally:
+            logout(self, user)
+
+
+class CalendarWindowTests(TestCase):
+
+    def test_time_window_month(self):
+        """
+        Tests that a month window covers the whole month, padded by a day on each side
+        """
+        time_min, time_max = tools.time_window(month=2, year=2000)
+
+        self.assertEquals(pytz.utc.localize(datetime(2000, 1, 31)), time_min)
+        self.assertEquals(pytz.utc.localize(datetime(2000, 3, 2)), time_max)
+
+    def test_time_window_no_year(self):
+        """
+        Tests that no window is built without a year
+        """
+        self.assertEquals((None, None), tools.time_window(day=1, month=1))
+
+    def test_get_events_from_calendar_without_mirror_sends_window(self):
+        """
+        Tests that reading google directly sends the date filter as timeMin/timeMax
+        """
+        queries = []
+
+        class NestedPlaceholder:
+            def execute(*args, **kwargs):
+                return {"items": [create_date(name="in window", year=2000, month=2, day=10)]}
+
+        class Placeholder:
+            def list(*args, **kwargs):
+                queries.append(kwargs)
+                return NestedPlaceholder()
+
+        when(services.calendar_service).events().thenReturn(Placeholder())
+
+        try:
+            with self.settings(EVENT_MIRROR_ENABLED=False):
+                events = tools.get_events_from_calendar("calendar", month=2, year=2000)
+            self.assertEquals(["in window"], [event["summary"] for event in events])
+            self.assertEquals(tools.time_window(month=2, year=2000)[0].isoformat(), queries[0]["timeMin"])
+            self.assertTrue(queries[0]["singleEvents"])
+            self.assertEquals("startTime", queries[0]["orderBy"])
+        finally:
+            unstub()
+
+    def test_get_events_from_calendar_mirror_window(self):
+        """
+        Tests that the mirror only returns events ending inside the requested month
+        """
+        events = [
+            dict(create_date(name=name, year=2000, month=month, day=10), id=name)
+            for month, name in [(1, "january"), (2, "february"), (3, "march")]
+        ] + [
+            # all-day events only have an end date
+            {"id": "all day", "summary": "all day", "end": {"date": "2000-02-20"}},
+            {"id": "all day march", "summary": "all day march", "end": {"date": "2000-03-01"}},
+            {"id": "no end", "summary": "no end"},
+        ]
+
+        class NestedPlaceholder:
+            def execute(*args, **kwargs):
+                return {"items": events}
+
+        class Placeholder:
+            def list(*args, **kwargs):
+                return NestedPlaceholder()
+
+        when(services.calendar_service).events().thenReturn(Placeholder())
+
+        try:
+            self.assertEquals(
+                ["february", "all day"],
+                [event["summary"] for event in tools.get_events_from_calendar("calendar", month=2, year=2000)],
+            )
+        finally:
+            unstub()
+
+
+class EventPaginationTests(TestCase):
+
+    def paged_placeholder(self, queries):
+        """
+        Returns a placeholder events() result with two pages of events, recording every query in queries
+        """
+
+        class NestedPlaceholder:
+            def __init__(self, page_token):
+                self.page_token = page_token
+
+            def execute(self, *args, **kwargs):
+                if self.page_token == None:
+                    return {"items": [dict(create_date(name="first"), id="first")], "nextPageToken": "second page"}
+                return {"items": [dict(create_date(name="second"), id="second")], "nextSyncToken": "token"}
+
+        class Placeholder:
+            def list(*args, **kwargs):
+                queries.append(dict(kwargs))
+                return NestedPlaceholder(kwargs.get("pageToken"))
+
+        return Placeholder()
+
+    def test_iter_events_follows_pages(self):
+        """
+        Tests that iterating a calendar follows nextPageToken until the last page, with the given page size
+        """
+        queries = []
+        when(services.calendar_service).events().thenReturn(self.paged_placeholder(queries))
+
+        try:
+            events = list(calendar_api.iter_events("calendar", page_size=1))
+            self.assertEquals(["first", "second"], [event["summary"] for event in events])
+            self.assertEquals("second page", queries[1]["pageToken"])
+            self.assertEquals(1, queries[0]["maxResults"])
+        finally:
+            unstub()
+
+    def test_iter_events_stops_early(self):
+        """
+        Tests that the next page is not requested if the caller stops consuming events
+        """
+        queries = []
+        when(services.calendar_service).events().thenReturn(self.paged_placeholder(queries))
+
+        try:
+            first = next(calendar_api.iter_events("calendar"))
+            self.assertEquals("first", first["summary"])
+            self.assertEquals(1, len(queries))
+        finally:
+            unstub()
+
+    def test_list_events_sync_token_from_last_page(self):
+        """
+        Tests that listing a calendar collects every page and keeps the sync token of the last page
+        """
+        queries = []
+        when(services.calendar_service).events().thenReturn(self.paged_placeholder(queries))
+
+        try:
+            items, sync_token = calendar_api.list_events("calendar")
+            self.assertEquals(2, len(items))
+            self.assertEquals("token", sync_token)
+        finally:
+            unstub()
+
+    def test_get_all_events_from_calendar_every_page(self):
+        """
+        Tests that reading a calendar through the mirror does not cut it off after the first page
+        """
+        queries = []
+        when(services.calendar_service).events().thenReturn(self.paged_placeholder(queries))
+
+        try:
+            events = list(tools.get_all_events_from_calendar("calendar", "class"))
+            self.assertEquals(["first", "second"], [event["summary"] for event in events])
+            self.assertEquals(["class", "class"], [event["className"] for event in events])
+        finally:
+            unstub()
+
+
+class BatchFetchTests(TestCase):
+
+    def setUp(self):
+        self.batches = []
+        batches = self.batches
+
+        class CountingBatch(services.FakeBatchRequest):
+            def execute(self, *args, **kwargs):
+                batches.append(len(self.requests))
+                super().execute(*args, **kwargs)
+
+        when(services.calendar_service).new_batch_http_request(callback=any).thenAnswer(
+            lambda callback: CountingBatch(callback)
+        )
+
+    def tearDown(self):
+        unstub()
+
+    def placeholder(self, broken_calendarId=None):
+        """
+        Returns a placeholder events() result with one event per calendar, named after the calendar
+        The calendar with broken_calendarId answers with an HTTP 500 error
+        """
+        from googleapiclient.errors import HttpError
+        import httplib2
+
+        class NestedPlaceholder:
+            def __init__(self, calendarId):
+                self.calendarId = calendarId
+
+            def execute(self, *args, **kwargs):
+                if self.calendarId == broken_calendarId:
+                    raise HttpError(httplib2.Response({"status": 500}), b"")
+                return {"items": [create_date(name=self.calendarId)]}
+
+        class Placeholder:
+            def list(*args, **kwargs):
+                return NestedPlaceholder(kwargs["calendarId"])
+
+        return Placeholder()
+
+    def create_student(self):
+        """
+        Creates a student with a personal calendar and two classes
+        """
+        user = login(self, create_student=False)
+        classes = {
+            models.Class.objects.create(calendarId="class1", className="Class one", professorId=0),
+            models.Class.objects.create(calendarId="class2", className="Class two", professorId=0),
+        }
+        student = models.Student.objects.create(
+            userId=user.id,
+            calendarId="personal",
+            classes=classes,
+            color="#000000",
+            class_colors=dict(),
+        )
+        return user, student
+
+    def test_refresh_one_batch(self):
+        """
+        Tests that syncing every calendar of a student takes a single batch request
+        """
+        when(services.calendar_service).events().thenReturn(self.placeholder())
+        user, student = self.create_student()
+
+        events = tools.get_events_from_calendar_all_classes(student)
+
+        self.assertEquals([3], self.batches)
+        self.assertEquals(
+            {("personal", None), ("class1", "Class one"), ("class2", "Class two")},
+            {(event["summary"], event["className"]) for event in events},
+        )
+        logout(self, user)
+
+    def test_refresh_fresh_calendars_no_batch(self):
+        """
+        Tests that calendars whose mirror is fresh are not requested again
+        """
+        when(services.calendar_service).events().thenReturn(self.placeholder())
+        user, student = self.create_student()
+
+        tools.get_events_from_calendar_all_classes(student)
+        tools.get_events_from_calendar_all_classes(student)
+
+        self.assertEquals([3], self.batches)
+        logout(self, user)
+
+    def test_refresh_failure_per_calendar(self):
+        """
+        Tests that a calendar failing to sync is reported on its own, without hiding the other calendars
+        """
+        when(services.calendar_service).events().thenReturn(self.placeholder("class2"))
+        user, student = self.create_student()
+
+        failures = event_mirror.refresh(["personal", "class1", "class2"])
+        events = tools.get_events_from_calendar_all_classes(student)
+
+        self.assertEquals(["class2"], list(failures))
+        self.assertEquals(500, failures["class2"].resp.status)
+        self.assertEquals({"personal", "class1"}, {event["summary"] for event in events})
+        logout(self, user)
+
+
+class ConcurrentFetchTests(TestCase):
+
+    def slow_placeholder(self, slow_calendarId):
+        """
+        Returns a placeholder events() result with one event per calendar, named after the calendar
+        The calendar with slow_calendarId takes a second to answer
+        """
+        import time
+
+        class NestedPlaceholder:
+            def __init__(self, calendarId):
+                self.calendarId = calendarId
+
+            def execute(self, *args, **kwargs):
+                if self.calendarId == slow_calendarId:
+                    time.sleep(1)
+                return {"items": [create_date(name=self.calendarId)]}
+
+        class Placeholder:
+            def list(*args, **kwargs):
+                return NestedPlaceholder(kwargs["calendarId"])
+
+        return Placeholder()
+
+    def test_fetch_pages_concurrently_deadline(self):
+        """
+        Tests that calendars missing the deadline are reported as timeouts, while the others arrive
+        """
+        import concurrent.futures
+
+        when(services.calendar_service).events().thenReturn(self.slow_placeholder("slow"))
+
+        try:
+            results = calendar_api.fetch_pages_concurrently(
+                [("fast", {}), ("slow", {})], deadline=0.3
+            )
+            self.assertEquals("fast", results[0][0]["items"][0]["summary"])
+            self.assertTrue(isinstance(results[1], concurrent.futures.TimeoutError))
+        finally:
+            unstub()
+
+    def test_todo_list_marks_missing_class(self):
+        """
+        Tests that the todo list renders the calendars that arrived, and a marker for a class that missed the deadline
+        """
+        when(services.calendar_service).events().thenReturn(self.slow_placeholder("class2"))
+        user = login(self, create_student=False)
+        models.Student.objects.create(
+            userId=user.id,
+            calendarId="personal",
+            classes={
+                models.Class.objects.create(calendarId="class1", className="Class one", professorId=0),
+                models.Class.objects.create(calendarId="class2", className="Class two", professorId=0),
+            },
+            color="#000000",
+            class_colors=dict(),
+        )
+        request = create_request(user.id)
+
+        try:
+            with self.settings(CALENDAR_FETCH_STRATEGY="threads", CALENDAR_FETCH_DEADLINE=0.3):
+                html = tools.todo_list(request)
+            self.assertTrue("Could not load assignments for Class two" in html)
+            self.assertTrue("class1" in html)
+            self.assertTrue("personal" in html)
+            self.assertEquals(["Class two"], tools.unavailable_calendars(request))
+        finally:
+            unstub()
+            logout(self, user)
+
+    def test_get_calendar_service_per_thread(self):
+        """
+        Tests that every thread other than the main thread gets its own calendar service
+        """
+        import threading
+
+        shared_service = services.calendar_service
+        services.calendar_service = "main thread service"
+        when(services).initialize_google_calendar_service(timeout=any).thenAnswer(
+            lambda timeout: object()
+        )
+        # the services each thread got, in the order it got them
+        thread_services = [[], []]
+
+        def use_service(seen):
+            seen.append(services.get_calendar_service())
+            seen.append(services.get_calendar_service())
+
+        try:
+            threads = [threading.Thread(target=use_service, args=(seen,)) for seen in thread_services]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEquals("main thread service", services.get_calendar_service())
+            first, second = thread_services
+            self.assertTrue(first[0] is first[1])
+            self.assertTrue(second[0] is second[1])
+            self.assertFalse(first[0] is second[0])
+        finally:
+            services.calendar_service = shared_service
+            unstub()
+
+
+class EventCacheTests(TestCase):
+
+    def setUp(self):
+        event_cache.cache.clear()
+
+        class NestedPlaceholder:
+            def execute(*args, **kwargs):
+                event = create_date(name="class event")
+                event["id"] = "class event"
+                return {"items": [event], "nextSyncToken": "token"}
+
+        class Placeholder:
+            def list(*args, **kwargs):
+                return NestedPlaceholder()
+
+        when(services.calendar_service).events().thenReturn(Placeholder())
+
+    def tearDown(self):
+        unstub()
+        event_cache.cache.clear()
+
+    def test_shared_between_readers(self):
+        """
+        Tests that the events of a calendar are only loaded from the database once for every reader
+        """
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        event_mirror.get_events("class calendar")
+        with CaptureQueriesContext(connection) as queries:
+            first = event_mirror.get_events("class calendar")
+            second = event_mirror.get_events("class calendar")
+        self.assertEquals(
+            [],
+            [query for query in queries.captured_queries if "mainapp_mirroredevent" in query["sql"]],
+        )
+        self.assertEquals(first, second)
+        self.assertFalse(first[0] is second[0])
+        self.assertEquals(2, event_cache.cache.stats()["hits"])
+        self.assertEquals(1, event_cache.cache.stats()["misses"])
+
+    def test_sync_changes_version(self):
+        """
+        Tests that a sync bringing in changes is never answered from the cache of the old version
+        """
+        event_mirror.get_events("class calendar")
+        changed = create_date(name="changed event")
+        changed["id"] = "class event"
+        event_mirror.mark_stale("class calendar")
+        state = event_mirror.get_sync_state("class calendar")
+        version = state.version
+        event_mirror.apply_pages(state, [{"items": [changed], "nextSyncToken": "next"}])
+        self.assertNotEquals(version, state.version)
+        events = event_mirror.get_events("class calendar")
+        self.assertEquals(["changed event"], [event["summary"] for event in events])
+
+    def test_save_event_patches_cache(self):
+        """
+        Tests that writing an event through updates the cached calendar in place
+        """
+        event_mirror.get_events("class calendar")
+        added = create_date(name="added event")
+        added["id"] = "added"
+        event_mirror.save_event("class calendar", added)
+        events = event_mirror.get_events("class calendar")
+        self.assertEquals(
+            ["class event", "added event"], [event["summary"] for event in events]
+        )
+        self.assertEquals(1, event_cache.cache.stats()["misses"])
+        event_mirror.remove_event("class calendar", "class event")
+        events = event_mirror.get_events("class calendar")
+        self.assertEquals(["added event"], [event["summary"] for event in events])
+        self.assertEquals(1, models.MirroredEvent.objects.filter(calendarId="class calendar").count())
+
+    def test_evicts_least_recently_used(self):
+        """
+        Tests that the process-wide cache stays within EVENT_CACHE_MAX_BYTES
+        """
+        import pickle
+
+        events = [(None, {"summary": "x" * 100})]
+        size = len(pickle.dumps(events, pickle.HIGHEST_PROTOCOL))
+        cache = event_cache.EventCache()
+        with self.settings(EVENT_CACHE_MAX_BYTES=size * 2):
+            cache.put("first", "v", events)
+            cache.put("second", "v", events)
+            cache.get("first", "v")
+            cache.put("third", "v", events)
+            self.assertEquals(["first", "third"], list(cache.entries))
+            self.assertEquals(1, cache.stats()["evictions"])
+            self.assertEquals(size * 2, cache.stats()["bytes"])
+
+    def test_cache_stats_staff_only(self):
+        """
+        Tests that only staff can see the cache stats
+        """
+        user = login(self)
+        try:
+            response = self.client.get("/cache_stats/")
+            self.assertEquals(302, response.status_code)
+            user.is_staff = True
+            user.save()
+            response = self.client.get("/cache_stats/")
+            self.assertEquals(200, response.status_code)
+            self.assertTrue("hits" in response.json())
+            self.assertEquals(os.getpid(), response.json()["process"])
+        finally:
+            logout(self, user)
+
+
+
+class StudentMiddlewareTests(TestCase):
+
+    def setUp(self):
+        self.user = login(self)
+        models.Student.objects.filter(userId=self.user.id).update(calendarId="calendar")
+
+    def tearDown(self):
+        logout(self, self.user)
+
+    def assertQueryBudget(self, page, budget):
+        """
+        Asserts that a page loads the student once, and stays within budget queries in total
+        """
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(page)
+        self.assertEquals(200, response.status_code)
+        student_queries = [
+            query for query in queries.captured_queries if "mainapp_student" in query["sql"]
+        ]
+        self.assertEquals(1, len(student_queries), page)
+        self.assertLessEqual(len(queries.captured_queries), budget, page)
+
+    def test_get_student_once_per_request(self):
+        """
+        Tests that the student helpers share a single lookup per request
+        """
+        request = create_request(self.user.id)
+        with self.assertNumQueries(1):
+            tools.get_student(request)
+            tools.student_exists(request)
+            tools.calendar_exists(request)
+            tools.is_professor(request)
+            tools.get_color(request)
+            tools.get_username(request)
+
+    def test_middleware_sets_student(self):
+        """
+        Tests that every request carries its student
+        """
+        response = self.client.get("/classes/")
+        self.assertEquals(self.user.id, response.wsgi_request.student.userId)
+
+    def test_initialize_user_sets_student(self):
+        """
+        Tests that a newly created student is visible to the rest of the request
+        """
+        models.Student.objects.filter(userId=self.user.id).delete()
+        request = create_request(self.user.id)
+        request.user.username = "user"
+        request.user.email = "test@test.com"
+        self.assertFalse(tools.student_exists(request))
+        tools.initialize_user(request)
+        with self.assertNumQueries(0):
+            self.assertTrue(tools.student_exists(request))
+
+    def test_view_query_budgets(self):
+        """
+        Tests that every page stays within a fixed number of queries
+        """
+        # the first sync of a calendar locks its CalendarSync row
+        self.assertQueryBudget("/", 16)
+        self.assertQueryBudget("/calendar/", 6)
+        self.assertQueryBudget("/classes/", 4)
+        self.assertQueryBudget("/todo/", 6)
+        self.assertQueryBudget("/all_classes/", 5)
+
+
+class EnrollmentTests(TestCase):
+
+    def setUp(self):
+        self.clazz = models.Class.objects.create(className="class1", professorId=0)
+        self.other = models.Class.objects.create(className="class2", professorId=0)
+
+    def test_classes_saved_as_enrollments(self):
+        """
+        Tests that assigning classes and class colors to a student writes Enrollment rows
+        """
+        student = models.Student.objects.create(
+            userId=0, classes={self.clazz, self.other}, class_colors={self.clazz: "#111111"}
+        )
+        student = models.Student.objects.get(pk=student.pk)
+        self.assertEquals({self.clazz, self.other}, student.classes)
+        self.assertEquals(
+            {self.clazz: "#111111", self.other: models.DEFAULT_CLASS_COLOR},
+            student.class_colors,
+        )
+
+        student.classes = {self.other}
+        student.save()
+        self.assertEquals(
+            [self.other.pk],
+            list(models.Enrollment.objects.filter(student=student).values_list("clazz_id", flat=True)),
+        )
+
+    def test_roster_single_query(self):
+        """
+        Tests that the students of a class are found with a single join
+        """
+        first = models.Student.objects.create(userId=0, classes={self.clazz})
+        models.Student.objects.create(userId=1, classes={self.other})
+        third = models.Student.objects.create(userId=2, classes={self.clazz, self.other})
+
+        with self.assertNumQueries(1):
+            self.assertEquals([first, third], tools.get_all_students("class1"))
+        with self.assertNumQueries(1):
+            self.assertEquals([first, third], tools.list_members_of_class("class1"))
+        self.assertEquals([], tools.list_members_of_class("no class"))
+
+    def test_migrate_enrollments(self):
+        """
+        Tests that the legacy pickled classes of a student are converted once, keeping their colors
+        """
+        from django.core.management import call_command
+        from io import StringIO
+
+        deleted = models.Class.objects.create(className="deleted", professorId=0)
+        student = models.Student.objects.create(
+            userId=0,
+            legacy_classes={self.clazz, self.other, deleted},
+            legacy_class_colors={self.clazz: "#111111"},
+        )
+        deleted.delete()
+
+        call_command("migrate_enrollments", stdout=StringIO())
+        call_command("migrate_enrollments", stdout=StringIO())
+
+        student = models.Student.objects.get(pk=student.pk)
+        self.assertEquals(2, models.Enrollment.objects.filter(student=student).count())
+        self.assertEquals(
+            {self.clazz: "#111111", self.other: models.DEFAULT_CLASS_COLOR},
+            student.class_colors,
+        )
+
+
+class CheckedAssignmentsTests(TestCase):
+
+    def test_checked_state_loaded_once(self):
+        """
+        Tests that rendering many events looks up the checked assignments of the student in one query
+        """
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        user = login(self)
+        request = create_request(user.id)
+        events = []
+        for day in range(1, 6):
+            event = create_date(name=f"event {day}", day=day)
+            event["id"] = f"event{day}"
+            event["organizer"] = {"email": "organizer"}
+            events.append(Event.from_google(event))
+        models.CheckedAssignments.objects.create(userId=user.id, className="None", eventId="event2")
+
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                html = tools.assignment_html(request, events, editable=True)
+                Calendar(year=2000, month=1).render_month(events, request)
+            checked_queries = [
+                query for query in queries.captured_queries
+                if "mainapp_checkedassignments" in query["sql"]
+            ]
+            self.assertEquals(1, len(checked_queries))
+            self.assertEquals(1, html.count("assignment checked"))
+            self.assertEquals(1, html.count("bx-check-square"))
+        finally:
+            logout(self, user)
+
+
+
+class CalendarRenderTests(TestCase):
+
+    def test_render_month_parses_each_event_once(self):
+        """
+        Tests that every event is parsed once, and shows up in the cell of the day it ends on
+        """
+        from . import event as event_module
+
+        parse_datetime = event_module.parse_datetime
+        parsed = []
+
+        def counting_parse_datetime(value):
+            parsed.append(value)
+            return parse_datetime(value)
+
+        events = []
+        for day in (3, 3, 17):
+            # test events end the day after they start
+            event = create_date(name=f"event on {day}", day=day - 1)
+            event["id"] = len(events)
+            events.append(event)
+        request = create_request(None)
+        request.checked_assignments = set()
+
+        event_module.parse_datetime = counting_parse_datetime
+        try:
+            html = Calendar(year=2000, month=1).render_month(events, request)
+        finally:
+            event_module.parse_datetime = parse_datetime
+
+        self.assertEquals([event["end"]["dateTime"] for event in events], parsed)
+        cells = html.split("<td>")
+        third = [cell for cell in cells if "<span class='date'>3</span>" in cell][0]
+        seventeenth = [cell for cell in cells if "<span class='date'>17</span>" in cell][0]
+        self.assertEquals(2, third.count("event on 3"))
+        self.assertTrue("event on 17" in seventeenth)
+        self.assertEquals(3, html.count("event on"))
+
+
+class EventTests(TestCase):
+
+    def test_from_google(self):
+        """
+        Tests that an event from the calendar api is parsed into a compact Event
+        """
+        google_event = create_date(name="assignment", day=5)
+        google_event["organizer"] = {"email": "organizer@email.com"}
+        google_event["end"] = {"dateTime": "2000-01-06T10:00:00"}
+        event = Event.from_google(google_event)
+
+        self.assertEquals("assignment", event.summary)
+        self.assertEquals(1234, event.id)
+        self.assertEquals("organizer@email.com", event.organizer)
+        self.assertEquals(datetime(2000, 1, 6, 10, tzinfo=pytz.utc), event.end)
+        self.assertFalse(hasattr(event, "__dict__"))
+
+    def test_todo_list_parses_each_event_once(self):
+        """
+        Tests that rendering the todo list parses the end of every event a single time
+        """
+        from . import event as event_module
+
+        user = login(self)
+        models.Student.objects.filter(userId=user.id).update(calendarId="personal")
+        request = create_request(user.id)
+        google_events = [create_date(name=f"event {day}", day=day) for day in (9, 3, 6)]
+        when(tools).get_all_events_from_calendar("personal", None).thenReturn(google_events)
+
+        parse_datetime = event_module.parse_datetime
+        parsed = []
+
+        def counting_parse_datetime(value):
+            parsed.append(value)
+            return parse_datetime(value)
+
+        event_module.parse_datetime = counting_parse_datetime
+        try:
+            html = tools.todo_list(request)
+            self.assertEquals(3, len(parsed))
+            self.assertTrue(html.index("event 3") < html.index("event 6") < html.index("event 9"))
+        finally:
+            event_module.parse_datetime = parse_datetime
+            unstub()
+            logout(self, user)
+
+
+class LazyContextProcessorTests(TestCase):
+
+    def setUp(self):
+        self.user = login(self)
+        models.Student.objects.filter(userId=self.user.id).update(calendarId="calendar", name="user")
+        self.clazz = models.Class.objects.create(
+            className="class1", professorId=self.user.id, calendarId="class calendar"
+        )
+        models.Student.objects.get(userId=self.user.id).enroll(self.clazz, color="#111111")
+
+    def tearDown(self):
+        logout(self, self.user)
+
+    def test_values_computed_once_when_read(self):
+        """
+        Tests that context processors do no work until a value is read, and then only once
+        """
+        request = create_request(self.user.id, className="class1")
+        with self.assertNumQueries(0):
+            context = {}
+            for processor in (
+                context_processors.is_professor,
+                context_processors.get_class_color,
+                context_processors.is_assigned_professor,
+                context_processors.is_my_class,
+                context_processors.get_name,
+            ):
+                context.update(processor(request))
+
+        # the student, the class of the page and the student's enrollments
+        with self.assertNumQueries(3):
+            self.assertEquals("#111111", context["CLASS_COLOR"])
+            self.assertTrue(context["IS_MY_CLASS"])
+            self.assertTrue(context["IS_ASSIGNED_PROFESSOR"])
+            self.assertFalse(context["USER_IS_PROFESSOR"])
+            self.assertEquals("user", str(context["USERNAME"]))
+        with self.assertNumQueries(0):
+            self.assertEquals("#111111", context["CLASS_COLOR"])
+            self.assertTrue(context["IS_MY_CLASS"])
+
+    def test_class_page_query_budgets(self):
+        """
+        Tests that class pages stay within a fixed number of queries
+        """
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        for page, budget in (("/classes/class1/view/", 14), ("/classes/class1/files/", 7)):
+            # the first load syncs the calendar mirrors
+            self.client.get(page)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(page)
+            self.assertEquals(200, response.status_code)
+            self.assertLessEqual(len(queries.captured_queries), budget, page)
+
+
+class CurrentClassMiddlewareTests(TestCase):
+
+    def setUp(self):
+        self.clazz = models.Class.objects.create(className="class1", professorId=0)
+
+    def routed_request(self, path):
+        """
+        Creates a request for path that went through the url resolver and CurrentClassMiddleware
+        """
+        from django.test import RequestFactory
+        from django.urls import resolve
+        from .middleware import CurrentClassMiddleware
+
+        request = RequestFactory().get(path)
+        request.resolver_match = resolve(path)
+        CurrentClassMiddleware(lambda request: None).process_view(
+            request,
+            request.resolver_match.func,
+            request.resolver_match.args,
+            request.resolver_match.kwargs,
+        )
+        return request
+
+    def test_class_route(self):
+        """
+        Tests that the class of a class page is loaded once, and shared for the rest of the request
+        """
+        with self.assertNumQueries(1):
+            request = self.routed_request("/classes/class1/files/")
+            self.assertEquals(self.clazz, tools.current_class(request))
+            self.assertEquals("class1", tools.className_from_url(request))
+
+    def test_nested_class_route(self):
+        """
+        Tests that a route with two class names belongs to the outer class
+        """
+        request = self.routed_request("/classes/class1/view/class2/1234/delete_assignment/check/")
+        self.assertEquals(self.clazz, request.current_class)
+
+    def test_non_class_route(self):
+        """
+        Tests that pages that do not belong to a class never query for one
+        """
+        with self.assertNumQueries(0):
+            for path in ("/calendar/", "/classes/", "/classes/create_class/"):
+                self.assertEquals(None, tools.current_class(self.routed_request(path)))
+
+
+class ColorResolverTests(TestCase):
+
+    def test_colors_resolved_once_per_request(self):
+        """
+        Tests that the colors of many classes are looked up once per request, and each class gets its color
+        """
+        user = login(self)
+        student = models.Student.objects.get(userId=user.id)
+        for name, color in (("class1", "#111111"), ("class2", "#222222")):
+            student.enroll(models.Class.objects.create(className=name, professorId=0), color=color)
+        request = create_request(user.id)
+
+        try:
+            # the student and their enrollments
+            with self.assertNumQueries(2):
+                for _ in range(5):
+                    self.assertEquals("#111111", tools.get_color(request, "class1"))
+                    self.assertEquals("#222222", tools.get_color(request, "class2"))
+                    self.assertEquals("#000000", tools.get_color(request, "not my class"))
+                    self.assertEquals("#000000", tools.get_color(request))
+        finally:
+            logout(self, user)
+
+
+class StudentStylesheetTests(TestCase):
+
+    def setUp(self):
+        self.user = login(self)
+        self.student = models.Student.objects.get(userId=self.user.id)
+        self.clazz = models.Class.objects.create(className="class 1", professorId=0)
+        self.student.enroll(self.clazz, color="#111111")
+
+    def tearDown(self):
+        logout(self, self.user)
+
+    def test_markup_references_classes(self):
+        """
+        Tests that rendered assignments carry css classes instead of inline styles, without any lookups
+        """
+        events = []
+        for i, description in enumerate(["class 1", None]):
+            event = create_date(name=f"event {i}")
+            event["id"] = f"event{i}"
+            event["description"] = description
+            events.append(Event.from_google(event))
+        request = create_request(self.user.id)
+        request.checked_assignments = {("None", "event1")}
+        request.student = None
+
+        with self.assertNumQueries(0):
+            html = tools.assignment_html(request, events, editable=True)
+            html += Calendar(year=2000, month=1).render_month(events, request)
+        self.assertFalse("style=" in html)
+        self.assertEquals(2, html.count(tools.class_css_classes("class 1")))
+        self.assertTrue('class="container assignment checked class-default"' in html)
+        self.assertTrue('class="calendar-event checked class-default"' in html)
+
+    def test_stylesheet(self):
+        """
+        Tests that the stylesheet holds a rule per class color, and is cached by the browser
+        """
+        response = self.client.get(f"/styles/{self.user.id}/{self.student.color_version}/student.css")
+        self.assertEquals(200, response.status_code)
+        self.assertEquals("text/css", response["Content-Type"])
+        self.assertTrue("max-age" in response["Cache-Control"])
+        css = response.content.decode()
+        self.assertTrue(".class-default { background-color: #000000; }" in css)
+        self.assertTrue(f".{tools.class_css_name('class 1')} {{ background-color: #111111; }}" in css)
+
+    def test_color_change_new_version(self):
+        """
+        Tests that changing a color moves the stylesheet to a new url, and old urls redirect to it
+        """
+        old_url = f"/styles/{self.user.id}/{self.student.color_version}/student.css"
+        request = create_request(self.user.id)
+        tools.set_class_color(request, "class 1", "#222222")
+        tools.set_class_color(request, None, "#333333")
+        new_url = tools.student_css_url(request)
+
+        self.assertNotEquals(old_url, new_url)
+        self.assertEquals(new_url, self.client.get("/").context["STUDENT_CSS"])
+        response = self.client.get(old_url)
+        self.assertEquals(302, response.status_code)
+        self.assertEquals(new_url, response.url)
+        css = self.client.get(new_url).content.decode()
+        self.assertTrue(".class-default { background-color: #333333; }" in css)
+        self.assertTrue("#222222" in css)
+
+    def test_stale_save_keeps_color_version(self):
+        """
+        Tests that saving an older copy of the student never puts color_version back to a used stylesheet url
+        """
+        stale = models.Student.objects.get(userId=self.user.id)
+        tools.set_class_color(create_request(self.user.id), "class 1", "#222222")
+        version = models.Student.objects.get(userId=self.user.id).color_version
+        self.assertTrue(version > stale.color_version)
+        stale.mood = "happy"
+        stale.save()
+        self.assertEquals(version, models.Student.objects.get(userId=self.user.id).color_version)
+        self.assertTrue(f"/{version}/" in tools.student_css_url(create_request(self.user.id)))
+
+    def test_only_hex_colors(self):
+        """
+        Tests that colors that are not hex colors never end up in the stylesheet
+        """
+        request = create_request(self.user.id)
+        tools.set_class_color(request, "class 1", "red; } body { display: none")
+        self.assertFalse("display" in tools.student_css(request))
+
+
+class TodoCacheTests(TestCase):
+
+    def setUp(self):
+        self.user = login(self)
+        models.Student.objects.filter(userId=self.user.id).update(calendarId="calendar")
+        tools.todo_cache().clear()
+        event = create_date(name="event 1")
+        event["id"] = "event1"
+        event["description"] = None
+        event["end"]["dateTime"] = (
+            datetime.now(tz=pytz.utc) + timedelta(days=2, hours=3)
+        ).isoformat()
+        self.events = [Event.from_google(event)]
+        self.renders = []
+        when(tools).get_all_events(any, any).thenAnswer(
+            lambda request, className: self.renders.append(className) or self.events
+        )
+
+    def tearDown(self):
+        unstub()
+        logout(self, self.user)
+
+    def todo_list(self):
+        request = create_request(self.user.id)
+        return tools.todo_list(request, editable=True)
+
+    def test_unchanged_todo_list_cached(self):
+        """
+        Tests that an unchanged todo list is only rendered once
+        """
+        html = self.todo_list()
+        self.assertTrue("event 1" in html)
+        self.assertEquals(html, self.todo_list())
+        self.assertEquals(1, len(self.renders))
+
+    def test_check_off_renders_again(self):
+        """
+        Tests that checking off an assignment shows up in the todo list right away
+        """
+        self.assertFalse("assignment checked" in self.todo_list())
+        tools.check_off(create_request(self.user.id), "event1", "None")
+        self.assertTrue("assignment checked" in self.todo_list())
+        self.assertEquals(2, len(self.renders))
+
+    def test_stale_save_keeps_checkmarks(self):
+        """
+        Tests that saving an older copy of the student does not put checked_version back
+        """
+        stale = models.Student.objects.get(userId=self.user.id)
+        self.assertFalse("assignment checked" in self.todo_list())
+        tools.check_off(create_request(self.user.id), "event1", "None")
+        stale.mood = "happy"
+        stale.save()
+        student = models.Student.objects.get(userId=self.user.id)
+        self.assertEquals(("happy", 1), (student.mood, student.checked_version))
+        self.assertTrue("assignment checked" in self.todo_list())
+
+    def test_changes_render_again(self):
+        """
+        Tests that new events and color changes are not hidden by the cache
+        """
+        self.todo_list()
+        event_mirror.save_event("calendar", create_date(name="event 2"))
+        self.todo_list()
+        tools.set_class_color(create_request(self.user.id), None, "#111111")
+        self.todo_list()
+        self.assertEquals(3, len(self.renders))
+
+    def test_expires_when_due_dates_change(self):
+        """
+        Tests that cached todo lists expire when the first due date string changes
+        """
+        seconds = Timeline(self.events).next_change()
+        self.assertTrue(3 * 60 * 60 - 60 < seconds <= 3 * 60 * 60, seconds)
+        self.assertEquals(24 * 60 * 60, Timeline([]).next_change())
+
+
+class MonthCacheTests(TestCase):
+
+    def setUp(self):
+        self.user = login(self)
+        models.Student.objects.filter(userId=self.user.id).update(calendarId="calendar")
+        month_cache.month_cache().clear()
+        event = create_date(name="event 1", day=15)
+        event["id"] = "event1"
+        event["description"] = None
+        self.renders = []
+        when(tools).get_events(any, month=any, year=any).thenAnswer(
+            lambda request, month, year: self.renders.append((year, month)) or [event]
+        )
+
+    def tearDown(self):
+        unstub()
+        logout(self, self.user)
+
+    def formatmonth(self, month=1):
+        return Calendar(year=2000, month=month).formatmonth(create_request(self.user.id))
+
+    def test_month_cached(self):
+        """
+        Tests that an unchanged month is only rendered once
+        """
+        html = self.formatmonth()
+        self.assertTrue("event 1" in html)
+        self.assertEquals(html, self.formatmonth())
+        self.assertEquals([(2000, 1)], self.renders)
+
+    def test_changes_render_again(self):
+        """
+        Tests that checkmarks, colors and events are not hidden by the cache
+        """
+        self.formatmonth()
+        tools.check_off(create_request(self.user.id), "event1", "None")
+        self.assertTrue("calendar-event checked" in self.formatmonth())
+        tools.set_class_color(create_request(self.user.id), None, "#111111")
+        self.formatmonth()
+        event_mirror.save_event("calendar", create_date(name="event 2"))
+        self.formatmonth()
+        self.assertEquals(4, len(self.renders))
+
+    def test_adjacent_months_prefetched(self):
+        """
+        Tests that the months around the one being viewed are rendered ahead, and then served from the cache
+        """
+        when(tools).get_events_from_calendar_all_classes(
+            any, month=any, year=any, failures=any
+        ).thenReturn([])
+        with self.settings(MONTH_PREFETCH="inline"):
+            self.formatmonth(1)
+        for year, month in ((1999, 12), (2000, 2)):
+            key = month_cache.month_key(create_request(self.user.id), year, month)
+            self.assertTrue(month_cache.cached_month(key) != None)
+
+        self.formatmonth(2)
+        self.assertEquals([(2000, 1)], self.renders)
+
+    def test_adjacent_months(self):
+        """
+        Tests that the months around the first and last month of a year are in the years around it
+        """
+        self.assertEquals([(1999, 12), (2000, 2)], month_cache.adjacent_months(2000, 1))
+        self.assertEquals([(2000, 11), (2001, 1)], month_cache.adjacent_months(2000, 12))
+
+
+class EventsApiTests(TestCase):
+
+    def setUp(self):
+        self.user = login(self)
+        models.Student.objects.filter(userId=self.user.id).update(calendarId="calendar")
+        event_mirror.refresh(["calendar"])
+        for i, day in enumerate([5, 20, 31]):
+            event = create_date(name=f"event {i}", day=day)
+            event["id"] = f"event{i}"
+            event_mirror.save_event("calendar", event)
+
+    def tearDown(self):
+        logout(self, self.user)
+
+    def test_events_in_range(self):
+        """
+        Tests that the events ending in the range are returned in order, with their checkmarks
+        """
+        models.CheckedAssignments.objects.create(userId=self.user.id, className="None", eventId="event1")
+        response = self.client.get("/api/events/?start=2000-01-01&end=2000-02-01")
+        self.assertEquals(200, response.status_code)
+        events = response.json()["events"]
+        self.assertEquals(["event0", "event1"], [event["id"] for event in events])
+        self.assertEquals([False, True], [event["checked"] for event in events])
+        self.assertEquals("2000-01-21T00:00:00+00:00", events[1]["end"])
+        self.assertEquals("class-default", events[0]["css_classes"])
+
+    def test_not_modified(self):
+        """
+        Tests that unchanged events reply 304, and that changes give a new ETag
+        """
+        url = "/api/events/?start=2000-01-01&end=2000-02-01"
+        etag = self.client.get(url)["ETag"]
+        self.assertTrue(etag.startswith('"'))
+        self.assertEquals(304, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+        tools.check_off(create_request(self.user.id), "event0", "None")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(200, response.status_code)
+        self.assertNotEquals(etag, response["ETag"])
+
+        event_mirror.save_event("calendar", create_date(name="event 3", day=10))
+        self.assertEquals(200, self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"]).status_code)
+        self.assertNotEquals(etag, self.client.get(url.replace("02-01", "01-15"))["ETag"])
+
+    def test_invalid_requests(self):
+        """
+        Tests that bad ranges and signed out users are refused
+        """
+        self.assertEquals(400, self.client.get("/api/events/?start=yesterday").status_code)
+        self.assertEquals(400, self.client.get("/api/events/?start=2000-02-01&end=2000-01-01").status_code)
+        self.assertEquals(405, self.client.post("/api/events/").status_code)
+        self.client.logout()
+        self.assertEquals(403, self.client.get("/api/events/").status_code)
+
+
+class AgendaTests(TestCase):
+
+    def setUp(self):
+        self.user = login(self)
+        models.Student.objects.filter(userId=self.user.id).update(calendarId="calendar")
+        event_mirror.refresh(["calendar"])
+        now = datetime.now(tz=pytz.utc)
+        for i in range(5):
+            due = timedelta(days=i + 1)
+            for name, end in ((f"future {i}", now + due), (f"past {i}", now - due)):
+                event = create_date(name=name)
+                event["id"] = name.replace(" ", "")
+                event["end"]["dateTime"] = end.isoformat()
+                event_mirror.save_event("calendar", event)
+
+    def tearDown(self):
+        logout(self, self.user)
+
+    def pages(self, past=False, limit=2):
+        """
+        Returns the names of the events of every page of the agenda
+        """
+        request = create_request(self.user.id)
+        pages = []
+        cursor = None
+        while True:
+            if cursor != None:
+                cursor = tools.decode_cursor(cursor)
+            events, cursor = tools.agenda_page(request, past=past, cursor=cursor, limit=limit)
+            pages.append([event.summary for event in events])
+            if cursor == None:
+                return pages
+
+    def test_pages(self):
+        """
+        Tests that the agenda pages through upcoming events soonest first, and past-due events latest first
+        """
+        self.assertEquals([["future 0", "future 1"], ["future 2", "future 3"], ["future 4"]], self.pages())
+        self.assertEquals([["past 0", "past 1"], ["past 2", "past 3"], ["past 4"]], self.pages(past=True))
+        self.assertEquals([["future 0", "future 1", "future 2", "future 3", "future 4"]], self.pages(limit=5))
+
+    def test_pages_without_mirror(self):
+        """
+        Tests that the agenda pages the same way when events are read from google
+        """
+        when(tools).get_all_events(any).thenReturn(
+            [
+                Event.from_google(dict(body, className=None))
+                for body in models.MirroredEvent.objects.values_list("body", flat=True)
+            ]
+        )
+        with self.settings(EVENT_MIRROR_ENABLED=False):
+            self.assertEquals([["future 0", "future 1"], ["future 2", "future 3"], ["future 4"]], self.pages())
+            self.assertEquals(["past 0", "past 1"], self.pages(past=True)[0])
+        unstub()
+
+    def test_all_day_event(self):
+        """
+        Tests that an all-day event (an end date without a time) is listed, due at the start of its day
+        """
+        day = datetime.now(tz=pytz.utc).date() + timedelta(days=3)
+        event = {"id": "allday", "summary": "all day", "start": {"date": day.isoformat()}, "end": {"date": day.isoformat()}}
+        event_mirror.save_event("calendar", event)
+        self.assertEquals(
+            ["future 0", "future 1", "all day", "future 2", "future 3", "future 4"], self.pages(limit=10)[0]
+        )
+        self.assertEquals(day, Event.from_google(event_mirror.get_events("calendar")[-1]).end.date())
+        response = self.client.get("/todo/?mode=agenda")
+        self.assertEquals(200, response.status_code)
+        self.assertContains(response, "all day")
+
+    def test_agenda_page(self):
+        """
+        Tests that the agenda page only renders the first upcoming events, and loads the rest when asked
+        """
+        with self.settings(AGENDA_PAGE_SIZE=2):
+            html = self.client.get("/todo/?mode=agenda").content.decode()
+            self.assertTrue("future 1" in html)
+            self.assertFalse("future 2" in html)
+            self.assertFalse("past 0" in html)
+            url = re.search('data-url="([^"]*cursor=[^"]*)"', html).group(1).replace("&amp;", "&")
+            html = self.client.get(url).content.decode()
+            self.assertTrue("future 2" in html and "future 3" in html)
+            html = self.client.get("/todo/agenda_items/?past=1").content.decode()
+            self.assertTrue("past 0" in html and "past 1" in html)
+            self.assertFalse("past 2" in html)
+        self.assertEquals(400, self.client.get("/todo/agenda_items/?cursor=bad").status_code)
+
+
+class TimelineTests(TestCase):
+
+    def setUp(self):
+        self.now = pytz.utc.localize(datetime(2000, 1, 15, 12))
+        self.events = [
+            Event(id=str(hours), summary=f"in {hours} hours", end=self.now + timedelta(hours=hours))
+            for hours in (50, -30, 0, 200, -1, 20)
+        ]
+
+    def summaries(self, events):
+        return [event.summary for event in events]
+
+    def test_split(self):
+        """
+        Tests that events are split around now, both halves in the order they are due
+        """
+        timeline = Timeline(self.events + [Event(summary="no end")], now=self.now)
+        self.assertEquals(["in -30 hours", "in -1 hours"], self.summaries(timeline.past()))
+        self.assertEquals(
+            ["in 0 hours", "in 20 hours", "in 50 hours", "in 200 hours"],
+            self.summaries(timeline.future()),
+        )
+        self.assertEquals(6, len(timeline))
+
+    def test_slices(self):
+        """
+        Tests slicing the timeline by due date
+        """
+        timeline = Timeline(self.events, now=self.now)
+        self.assertEquals(
+            ["in 0 hours", "in 20 hours", "in 50 hours"],
+            self.summaries(timeline.due_within(timedelta(days=7))),
+        )
+        self.assertEquals(
+            ["in -1 hours", "in 0 hours"],
+            self.summaries(timeline.between(self.now - timedelta(hours=1), self.now + timedelta(hours=1))),
+        )
+        self.assertEquals(["in 200 hours"], self.summaries(timeline.between(start=self.now + timedelta(days=3))))
+
+    def test_days_until(self):
+        """
+        Tests that due dates are counted from the timeline's now, matching days_until_string
+        """
+        timeline = Timeline(self.events, now=self.now)
+        self.assertEquals([-2, -1, 0, 0, 2, 8], [timeline.days_until(event) for event in timeline])
+        self.assertEquals("Due in 2 Days", tools.days_until_string(self.now + timedelta(hours=50), self.now))
+        self.assertEquals("Due 2 Days Ago", tools.days_until_string(self.now - timedelta(hours=30), self.now))
+        self.assertEquals(2 * 60 * 60, timeline.next_change())
+
+
+class DailyDigestTests(TestCase):
+
+    def setUp(self):
+        self.now = datetime.now(tz=pytz.UTC) - timedelta(days=1)
+        self.classes = [
+            models.Class.objects.create(className=f"class {i}", professorId=0, calendarId=f"class{i}")
+            for i in range(2)
+        ]
+        self.users = []
+        for i in range(4):
+            user = User.objects.create(username=f"user{i}", email=f"user{i}@test.com")
+            student = models.Student.objects.create(userId=user.id, calendarId=f"personal{i}", name=f"user {i}")
+            for clazz in self.classes[: i % 3]:
+                student.enroll(clazz)
+            self.users.append(user)
+
+        self.reads = []
+
+        def read(calendarId, day, month, year):
+            self.reads.append(calendarId)
+            event = create_date(name=f"{calendarId} assignment", year=year, month=month, day=day)
+            event["className"] = None
+            return [event]
+
+        when(tools).get_events_from_calendar(any, day=any, month=any, year=any).thenAnswer(read)
+
+    def tearDown(self):
+        unstub()
+
+    def test_each_calendar_read_once(self):
+        """
+        Tests that every calendar is read once, however many students are in its class
+        """
+        stats = tools.notify_students_of_today_assignments()
+        self.assertEquals(
+            sorted([f"personal{i}" for i in range(4)] + ["class0", "class1"]), sorted(self.reads)
+        )
+        self.assertEquals(4, stats["notified"])
+        self.assertEquals(6, stats["calendars"])
+        self.assertTrue(stats["seconds"] >= 0)
+
+    def test_students_get_their_classes(self):
+        """
+        Tests that every student is sent the assignments of their own calendar and classes, grouped by class
+        """
+        tools.notify_students_of_today_assignments()
+        text = models.Notification.objects.get(email="user2@test.com").text
+        self.assertTrue("For Personal:<br>&emsp;personal2 assignment" in text)
+        self.assertTrue("For class 0:<br>&emsp;class0 assignment" in text)
+        self.assertTrue("For class 1:<br>&emsp;class1 assignment" in text)
+        self.assertFalse("personal1" in text)
+        text = models.Notification.objects.get(email="user0@test.com").text
+        self.assertFalse("class0" in text)
+
+    def test_api_calls_counted(self):
+        """
+        Tests that calls to the calendar api are counted, both single and batched requests
+        """
+        before = calendar_api.counter.snapshot()
+        list(calendar_api.iter_event_pages("calendar"))
+        calendar_api.batch_first_pages([("calendar", {}), ("other", {})])
+        after = calendar_api.counter.snapshot()
+        self.assertEquals(3, after["calls"] - before["calls"])
+        self.assertEquals(2, after["round_trips"] - before["round_trips"])
+
+    def test_shards_split_students(self):
+        """
+        Tests that the shards of both strategies do not overlap and together hold every student
+        """
+        everyone = sorted(models.Student.objects.values_list("id", flat=True))
+        for strategy in ["hash", "range"]:
+            shards = [
+                list(digest.part_students(shard, 3, strategy=strategy).values_list("id", flat=True))
+                for shard in range(3)
+            ]
+            self.assertEquals(everyone, sorted(sum(shards, [])))
+            self.assertTrue(all(len(shard) <= 2 for shard in shards))
+
+    def test_shards_independent_of_workers(self):
+        """
+        Tests that the students of a shard do not depend on its number of workers, so dynos can use different ones
+        """
+        for i in range(4, 12):
+            models.Student.objects.create(userId=1000 + i, calendarId=f"personal{i}", name=f"user {i}")
+        everyone = sorted(models.Student.objects.values_list("id", flat=True))
+
+        def students(shard, shards, workers, strategy):
+            return sorted(
+                id
+                for worker in range(workers)
+                for id in digest.part_students(shard, shards, worker, workers, strategy).values_list("id", flat=True)
+            )
+
+        for strategy in ["hash", "range"]:
+            for workers in [1, 2, 3, 5]:
+                for shard in range(2):
+                    self.assertEquals(students(shard, 2, 1, strategy), students(shard, 2, workers, strategy))
+            # one dyno on 2 workers and the other on 1 still cover everyone once
+            self.assertEquals(everyone, sorted(students(0, 2, 2, strategy) + students(1, 2, 1, strategy)))
+
+    def test_sharded_digest(self):
+        """
+        Tests that each shard only notifies its own students, and that all shards together notify everyone once
+        """
+        notified = 0
+        for shard in range(2):
+            stats = tools.notify_students_of_today_assignments(shard=shard, shards=2)
+            self.assertEquals(stats["notified"], models.Notification.objects.count() - notified)
+            notified = models.Notification.objects.count()
+        self.assertEquals(4, notified)
+        self.assertEquals(4, models.Notification.objects.values("email").distinct().count())
+
+    def test_digest_worker_processes(self):
+        """
+        Tests that the parts of a shard run on worker processes, and that their counts are merged
+        """
+
+        def run_part(day, shard, shards, worker, workers, strategy):
+            return {"parts": 1, "students": worker, "notified": 1, "failures": [f"{shard} {worker} of {workers}"]}
+
+        # the worker processes are forked, so they run the stubbed run_part
+        when(digest).run_part(any, any, any, any, any, any).thenAnswer(run_part)
+        stats = tools.notify_students_of_today_assignments(workers=2, shard=1, shards=2)
+        self.assertEquals(2, stats["parts"])
+        self.assertEquals(0 + 1, stats["students"])
+        self.assertEquals(2, stats["notified"])
+        self.assertEquals(["1 0 of 2", "1 1 of 2"], sorted(stats["failures"]))
+        # the connection of this process still works once the workers are done
+        self.assertEquals(4, models.Student.objects.count())
+
+    def test_failed_parts_reported(self):
+        """
+        Tests that a part that fails is reported in the failures of the digest, along with failed calendars
+        """
+        when(digest).run_part(any, any, any, any, any, any).thenRaise(ValueError("lost connection"))
+        stats = tools.notify_students_of_today_assignments()
+        self.assertEquals(1, stats["parts"])
+        self.assertEquals(0, stats["notified"])
+        self.assertEquals(["shard 0 worker 0: ValueError('lost connection')"], stats["failures"])
+
+        merged = digest.merge(
+            [{"parts": 1, "notified": 2, "failures": ["calendar x: error"]}, digest.failed_part(0, 1, ValueError())]
+        )
+        self.assertEquals(2, merged["parts"])
+        self.assertEquals(2, merged["notified"])
+        self.assertEquals(2, len(merged["failures"]))
@@ -0,0 +1,72 @@
+import bisect
+import datetime
+import pytz
+from .event import as_event
+
+DAY_SECONDS = 24 * 60 * 60
+
+
+class Timeline:
+    """
+    Events sorted by when they are due, seen from a single snapshot of the current time (now)
+    Splitting past from future and slicing by due date are bisections of the sorted due dates,
+    instead of passes over every event. Events without an end are left out
+    """
+
+    def __init__(self, events, now=None):
+        self.events = sorted(
+            (event for event in map(as_event, events) if event.end != None),
+            key=lambda event: event.end,
+        )
+        self.ends = [event.end for event in self.events]
+        self.now = now if now != None else datetime.datetime.now(tz=pytz.utc)
+
+    def __len__(self):
+        return len(self.events)
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def index(self, when):
+        """
+        Returns the position of the first event due at or after when
+        """
+        return bisect.bisect_left(self.ends, when)
+
+    def past(self):
+        """
+        Returns the events that were due before now, soonest first
+        """
+        return self.events[: self.index(self.now)]
+
+    def future(self):
+        """
+        Returns the events due now or later, soonest first
+        """
+        return self.events[self.index(self.now) :]
+
+    def between(self, start=None, end=None):
+        """
+        Returns the events due in [start, end), soonest first. A missing bound is not checked
+        """
+        first = 0 if start == None else self.index(start)
+        last = len(self.events) if end == None else self.index(end)
+        return self.events[first:last]
+
+    def due_within(self, delta):
+        """
+        Returns the events due from now until delta (a timedelta) from now, for example "due this week"
+        """
+        return self.between(self.now, self.now + delta)
+
+    def days_until(self, event):
+        """
+        Returns the number of whole days from now until an event is due, negative once it is past due
+        """
+        return (event.end - self.now).days
+
+    def next_change(self):
+        """
+        Returns the number of seconds until days_until changes for one of the events, at most a day
+        """
+        return min(((end - self.now).seconds or DAY_SECONDS for end in self.ends), default=DAY_SECONDS)
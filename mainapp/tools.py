@@ -1,10 +1,26 @@
 import pytz
 from . import services
 from . import models
+from . import event_mirror
+from . import calendar_api
+from .event import Event, as_event, event_end, parse_datetime
+from .timeline import Timeline
+import base64
 import datetime
+import hashlib
+import itertools
+import json
 import logging
+import re
+import time
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db.models import Max, OuterRef, Subquery
+from django.urls import reverse
 from django.template import Context, Template
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
 
 # calendar api query documentation : https://developers.google.com/calendar/api
 
@@ -14,7 +30,26 @@ logger = logging.getLogger(__name__)
 def get_student(request):
     """
     Gets the student model that corresponds to the user id for the current request
+    The student is loaded once per request and kept in request.student (see middleware.StudentMiddleware)
     """
+    return request_student(request)
+
+
+def request_student(request):
+    """
+    Returns request.student, loading it first if this request has not looked it up yet
+    """
+    if "student" not in vars(request):
+        request.student = load_student(request)
+    return request.student
+
+
+def load_student(request):
+    """
+    Loads the student model for the current request from the database, or None if there is none
+    """
+    if request.user.id == None:
+        return None
     return models.Student.objects.filter(userId=request.user.id).first()
 
 
@@ -60,14 +95,16 @@ def is_professor_for_class(request, className):
 def is_admin_of_event(request, event):
     """
     Returns whether or not the corresponding request owner is the creator of some event
+    event is an Event, or an event dictionary from the calendar api
     """
     if not student_exists(request):
         return False
-    
-    if is_professor_for_class(request, event['className']):
+
+    event = as_event(event)
+    if is_professor_for_class(request, event.className):
         return True
 
-    if event['organizer']['email'] == get_student(request).calendarId:
+    if event.organizer == get_student(request).calendarId:
         return True
 
     return False
@@ -77,10 +114,7 @@ def student_exists(request):
     """
     Determines if there is a student with an id tied to this request
     """
-    return (
-        request.user.id != None
-        and models.Student.objects.filter(userId=request.user.id).count() != 0
-    )
+    return request.user.id != None and request_student(request) != None
 
 
 def initialize_user(request):
@@ -88,7 +122,7 @@ def initialize_user(request):
     Initializes the current user if they are not currently initialized
     """
     if not request.user.id == None and not student_exists(request):
-        models.Student.objects.create(
+        request.student = models.Student.objects.create(
             userId=request.user.id,
             classes=set(),
             name=request.user.username,
@@ -124,7 +158,7 @@ def create_event(request, summary, time, className=None, isPersonal=False):
     else:
         calendarId = get_class(className).calendarId
 
-    event = (
+    created_event = (
         services.calendar_service.events()
         .insert(
             calendarId=calendarId,
@@ -137,6 +171,11 @@ def create_event(request, summary, time, className=None, isPersonal=False):
         )
         .execute()
     )
+    # write the new event through to the mirror, so every student sees it right away
+    if created_event.get("id") and created_event.get("end"):
+        event_mirror.save_event(calendarId, created_event)
+    else:
+        event_mirror.mark_stale(calendarId)
     print("Event created for user")
 
 
@@ -162,6 +201,7 @@ def delete_event(request, id, clazz):
     services.calendar_service.events().delete(
         calendarId=calendarId, eventId=id
     ).execute()
+    event_mirror.remove_event(calendarId, id)
 
 
 def create_calendar(request):
@@ -203,11 +243,7 @@ def create_calendar(request):
 
 
 def calendar_exists(request):
-    return (
-        request.user.id != None
-        and models.Student.objects.filter(userId=request.user.id).count() != 0
-        and get_student(request).calendarId != ""
-    )
+    return student_exists(request) and get_student(request).calendarId != ""
 
 
 def get_events_from_calendar(
@@ -215,47 +251,118 @@ def get_events_from_calendar(
 ):
     """
     Returns all events during specified day month year from calendar with calendarId
+    Events are read from the local mirror (see event_mirror), which syncs with google when it is stale
     If any of those are none, it does not filter. 
     Also, will assign className className to each event, if specified
     This way, calendar view can determine a potential color code for classes
     """
-    events = services.calendar_service.events().list(calendarId=calendarId).execute()
-    events = events["items"]
+    return list(
+        iter_events_from_calendar(
+            calendarId, day=day, month=month, year=year, className=className
+        )
+    )
 
-    if day != None:
-        events = [
-            event
-            for event in events
-            if datetime.datetime.fromisoformat(event["end"]["dateTime"]).day == day
-        ]
 
-    if month != None:
-        events = [
-            event
-            for event in events
-            if datetime.datetime.fromisoformat(event["end"]["dateTime"]).month == month
-        ]
+def iter_events_from_calendar(
+    calendarId, day=None, month=None, year=None, className=None, page_size=None
+):
+    """
+    Lazily yields the events during specified day month year from calendar with calendarId
+    (see get_events_from_calendar). Events are filtered and yielded as their page arrives,
+    and no more pages are read once the caller stops consuming.
+    page_size is the number of events read per page, default settings.EVENT_PAGE_SIZE
+    """
+    time_min, time_max = time_window(day=day, month=month, year=year)
+    for event in iter_events_in_window(calendarId, time_min, time_max, page_size=page_size):
+        if ends_on(event, day=day, month=month, year=year):
+            event["className"] = className
+            yield event
 
-    if year != None:
-        events = [
-            event
-            for event in events
-            if datetime.datetime.fromisoformat(event["end"]["dateTime"]).year == year
-        ]
 
-    for event in events:
-        event["className"] = className
+def iter_events_in_window(calendarId, time_min=None, time_max=None, page_size=None):
+    """
+    Lazily yields the event dictionaries of the calendar with calendarId around [time_min, time_max),
+    from the local mirror (see event_mirror) or straight from google if the mirror is disabled
+    The window only narrows what is read, callers still check the end of each event
+    """
+    if settings.EVENT_MIRROR_ENABLED:
+        return event_mirror.iter_events(
+            calendarId, time_min=time_min, time_max=time_max, page_size=page_size
+        )
+    return calendar_api.iter_events(
+        calendarId,
+        page_size=page_size,
+        **calendar_api.window_query(time_min, time_max),
+    )
 
-    return events
 
+def time_window(day=None, month=None, year=None):
+    """
+    Returns a (time_min, time_max) pair of aware datetimes around the given day, month or year
+    This is used to only query events that could end on that date, instead of every event in a calendar
+    The window is padded by a day on each side, since ends_on compares dates in each event's own timezone
+    Returns (None, None) if there is no year to build a window from
+    """
+    if year == None:
+        return None, None
+    if month == None:
+        start = datetime.datetime(year, 1, 1)
+        end = datetime.datetime(year + 1, 1, 1)
+    elif day == None:
+        start = datetime.datetime(year, month, 1)
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+    else:
+        start = datetime.datetime(year, month, day)
+        end = start + datetime.timedelta(days=1)
+    padding = datetime.timedelta(days=1)
+    return pytz.utc.localize(start - padding), pytz.utc.localize(end + padding)
 
-def get_events_from_calendar_all_classes(student, day=None, month=None, year=None):
-    events = get_events_from_calendar(
-        student.calendarId, day=day, month=month, year=year,
+
+def ends_on(event, day=None, month=None, year=None):
+    """
+    Returns whether or not an event ends on the given day, month and year
+    If any of those are none, it is not compared. Events without an end never match a date
+    """
+    if day == None and month == None and year == None:
+        return True
+    end = event_end(event)
+    if end == None:
+        return False
+    return (
+        (day == None or end.day == day)
+        and (month == None or end.month == month)
+        and (year == None or end.year == year)
     )
 
-    for clazz in student.classes:
+
+def get_events_from_calendar_all_classes(
+    student, day=None, month=None, year=None, missing=None, failures=None
+):
+    """
+    Returns the events of the personal calendar and every class calendar of a student
+    If missing is a list, the names of calendars that could not be loaded are added to it
+    failures are the calendars that failed to sync, if the calendars were already refreshed
+    """
+    classes = list(student.classes)
+    if failures == None:
+        failures = refresh_calendars(
+            [student.calendarId] + [clazz.calendarId for clazz in classes]
+        )
+
+    events = []
+    if student.calendarId not in failures:
+        events += get_events_from_calendar(
+            student.calendarId, day=day, month=month, year=year,
+        )
+    elif missing != None:
+        missing.append("Personal")
+
+    for clazz in classes:
         print(clazz.className)
+        if clazz.calendarId in failures:
+            if missing != None:
+                missing.append(clazz.className)
+            continue
         events += get_events_from_calendar(
             clazz.calendarId,
             day=day,
@@ -266,6 +373,55 @@ def get_events_from_calendar_all_classes(student, day=None, month=None, year=Non
     return events
 
 
+def refresh_calendars(calendarIds):
+    """
+    Brings the local mirror of every calendar in calendarIds up to date, in one batched round trip to google
+    Returns a dictionary from calendarId to error for the calendars that failed to sync
+    These calendars should be skipped when reading, so a single broken calendar does not break the page
+    """
+    if not settings.EVENT_MIRROR_ENABLED:
+        return {}
+    failures, _ = refresh_calendar_versions(calendarIds)
+    return failures
+
+
+def refresh_calendar_versions(calendarIds):
+    """
+    Brings the mirror of every calendar in calendarIds up to date (see refresh_calendars)
+    Returns the failures, and a dictionary from calendarId to the version of its mirror (see event_mirror)
+    """
+    failures, versions = event_mirror.refresh_versions(calendarIds)
+    for calendarId, error in failures.items():
+        print("Failed to sync calendar", calendarId, error)
+    return failures, versions
+
+
+def refresh_request_calendars(request, calendarIds):
+    """
+    Refreshes calendarIds (see refresh_calendars) once per request, so the todo cache and the events it
+    renders share a single refresh. The versions of the mirrors are kept in request.calendar_versions,
+    with None for the calendars that failed. Returns the failures among calendarIds
+    """
+    if not settings.EVENT_MIRROR_ENABLED:
+        return {}
+    versions = vars(request).setdefault("calendar_versions", {})
+    failures = vars(request).setdefault("calendar_failures", {})
+    missing = [calendarId for calendarId in calendarIds if str(calendarId) not in versions]
+    if len(missing) != 0:
+        new_failures, new_versions = refresh_calendar_versions(missing)
+        new_failures = {str(calendarId): error for calendarId, error in new_failures.items()}
+        for calendarId in missing:
+            failure = new_failures.get(str(calendarId))
+            if failure != None:
+                failures[str(calendarId)] = failure
+            versions[str(calendarId)] = None if failure != None else new_versions[str(calendarId)]
+    return {
+        calendarId: failures[str(calendarId)]
+        for calendarId in calendarIds
+        if str(calendarId) in failures
+    }
+
+
 def get_events(request, day=None, month=None, year=None):
     """
     Gets all events from a calendar associated with the user making the current request
@@ -279,12 +435,45 @@ def get_events(request, day=None, month=None, year=None):
     print("Getting events for student")
 
     student = get_student(request)
+    failures = refresh_request_calendars(
+        request, [calendarId for calendarId, _ in todo_calendars(request)]
+    )
 
     return get_events_from_calendar_all_classes(
-        student, day=day, month=month, year=year
+        student,
+        day=day,
+        month=month,
+        year=year,
+        missing=unavailable_calendars(request),
+        failures=failures,
     )
 
 
+def unavailable_calendars(request):
+    """
+    Returns the names of the calendars (class names, or Personal) that could not be loaded during this request
+    Pages render what did load, and use missing_calendars_html to show which classes are missing
+    """
+    if request == None:
+        return []
+    if "unavailable_calendars" not in vars(request):
+        request.unavailable_calendars = []
+    return request.unavailable_calendars
+
+
+def missing_calendars_html(request):
+    """
+    Returns an HTML notice listing the calendars that could not be loaded for this request, if any
+    """
+    missing = unavailable_calendars(request)
+    if len(missing) == 0:
+        return ""
+    return f"""<div class="container" style="border-radius:1.5vh; background-color:#ffc107; color:black;
+        padding-left:5%; margin-bottom: 10px;">
+        Could not load assignments for {", ".join(sorted(set(missing)))}. Try again in a moment.
+        </div>"""
+
+
 def get_all_events(request, className=None):
     """
     Returns all events from user belonging to request and from classname classname
@@ -292,6 +481,160 @@ def get_all_events(request, className=None):
     if not student_exists(request):
         return []
 
+    calendarIds = todo_calendars(request, className)
+    failures = refresh_request_calendars(request, [calendarId for calendarId, _ in calendarIds])
+    for calendarId, name in calendarIds:
+        if calendarId in failures:
+            unavailable_calendars(request).append(
+                "Personal" if name == None else name
+            )
+
+    # calendars are streamed one after another, so events are filtered as their pages arrive
+    events = itertools.chain.from_iterable(
+        get_all_events_from_calendar(calendarId, name)
+        for calendarId, name in calendarIds
+        if calendarId not in failures
+    )
+
+    # events are parsed once here, everything that renders them reads the parsed Event
+    return [
+        event
+        for event in map(Event.from_google, events)
+        if event.description == str(className) or str(className) == 'None'
+    ]
+
+
+def get_events_between(request, start, end):
+    """
+    Returns the Events of the personal and class calendars of the student of this request that end
+    in [start, end) (aware datetimes), ordered by their end
+    Calendars that could not be loaded are skipped, and listed in unavailable_calendars
+    """
+    if not student_exists(request):
+        return []
+
+    calendarIds = todo_calendars(request)
+    failures = refresh_request_calendars(request, [calendarId for calendarId, _ in calendarIds])
+    events = []
+    for calendarId, name in calendarIds:
+        if calendarId in failures:
+            unavailable_calendars(request).append("Personal" if name == None else name)
+            continue
+        for event in iter_events_in_window(calendarId, start, end):
+            event["className"] = name
+            event = Event.from_google(event)
+            if event.end != None and start <= event.end < end:
+                events.append(event)
+    return sorted(events, key=lambda event: event.end)
+
+
+def event_json(request, event):
+    """
+    Returns what the events api (see views.events_api) shows of an Event
+    Colors are not included, they come from the student's stylesheet through css_classes (see student_css)
+    """
+    return {
+        "id": event.id,
+        "summary": event.summary,
+        "description": event.description,
+        "className": event.className,
+        "end": event.end.isoformat(),
+        "checked": is_checked_off(request, event),
+        "css_classes": class_css_classes(event.description),
+    }
+
+
+def agenda_page(request, past=False, cursor=None, limit=None):
+    """
+    Returns a page of the agenda of the student of this request, and the cursor of the next page (None if
+    it is the last page). A page holds the next limit (default settings.AGENDA_PAGE_SIZE) upcoming Events
+    after cursor, soonest first, or with past, the past-due Events before cursor, latest first
+    cursor is an (end, eventId) pair (see decode_cursor). Only the page is read from the mirror
+    """
+    if not student_exists(request):
+        return [], None
+    if limit == None:
+        limit = settings.AGENDA_PAGE_SIZE
+    now = request_now(request)
+    time_min, time_max = (None, now) if past else (now, None)
+
+    calendarIds = todo_calendars(request)
+    if settings.EVENT_MIRROR_ENABLED:
+        failures = refresh_request_calendars(request, [calendarId for calendarId, _ in calendarIds])
+        for calendarId, name in calendarIds:
+            if calendarId in failures:
+                unavailable_calendars(request).append("Personal" if name == None else name)
+        names = {str(calendarId): name for calendarId, name in calendarIds}
+        # one more event than the page, to know if there is a next page
+        rows = event_mirror.get_page(
+            [calendarId for calendarId, _ in calendarIds if calendarId not in failures],
+            time_min=time_min,
+            time_max=time_max,
+            cursor=cursor,
+            reverse=past,
+            limit=limit + 1,
+        )
+        events = [
+            Event.from_google(dict(body, className=names[calendarId])) for calendarId, body in rows
+        ]
+    else:
+        timeline = Timeline(get_all_events(request), now=now)
+        events = sorted(
+            timeline.past() if past else timeline.future(),
+            key=lambda event: (event.end, str(event.id)),
+            reverse=past,
+        )
+        if cursor != None:
+            if past:
+                events = [event for event in events if (event.end, str(event.id)) < cursor]
+            else:
+                events = [event for event in events if (event.end, str(event.id)) > cursor]
+        events = events[: limit + 1]
+
+    if len(events) <= limit:
+        return events, None
+    return events[:limit], encode_cursor(events[limit - 1])
+
+
+def encode_cursor(event):
+    """
+    Returns the agenda cursor pointing right after an Event: its due date and id, in a url-safe string
+    """
+    value = json.dumps([event.end.isoformat(), str(event.id)])
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (end, eventId) pair of an agenda cursor (see encode_cursor), or None if it is not valid
+    """
+    try:
+        end, eventId = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return parse_datetime(end), str(eventId)
+    except (ValueError, TypeError):
+        return None
+
+
+def agenda_html(request, past=False, cursor=None):
+    """
+    Returns the HTML of a page of the agenda (see agenda_page), ending with a button that loads the next page
+    """
+    events, next_cursor = agenda_page(request, past=past, cursor=cursor)
+    return get_template("mainapp/agenda_items.html").render(
+        {
+            "assignments": assignment_rows(request, events, editable=True),
+            "editable": True,
+            "past": past,
+            "cursor": next_cursor,
+        }
+    ).strip()
+
+
+def todo_calendars(request, className=None):
+    """
+    Returns the (calendarId, className) pairs of the calendars read by get_all_events, the personal
+    calendar of the student first (with className None)
+    """
     student = get_student(request)
     calendarIds = [(student.calendarId, None)]
     if className != None:
@@ -299,27 +642,17 @@ def get_all_events(request, className=None):
     else:
         for clazz in student.classes:
             calendarIds.append((clazz.calendarId, clazz.className))
+    return calendarIds
 
-    events = []
-    for calendarId, name in calendarIds:
-        events += get_all_events_from_calendar(calendarId, name)
-
-    return [event for event in events if event['description'] == str(className) or str(className) == 'None']
 
-
-def get_all_events_from_calendar(calendarId, className=None):
+def get_all_events_from_calendar(calendarId, className=None, page_size=None):
     """
     Returns all events from a given calendar
+    Events are returned as a lazy iterator, which reads the calendar one page at a time
     """
     print(datetime.datetime.now().isoformat())
     print(calendarId)
-    events = services.calendar_service.events().list(calendarId=calendarId).execute()
-    events = events["items"]
-
-    for event in events:
-        event["className"] = className
-
-    return events
+    return iter_events_from_calendar(calendarId, className=className, page_size=page_size)
 
 
 def get_date(request):
@@ -333,6 +666,30 @@ def get_date(request):
     return datetime.datetime.now(tz=pytz.utc)
 
 
+def get_date_range(request):
+    """
+    Gets the (start, end) range of aware datetimes asked for by the start and end parameters of a request
+    (isoformat dates or datetimes, in UTC unless they have a timezone), default the current month
+    Returns None if they are not valid dates, or end is not after start
+    """
+    try:
+        if "start" in request.GET:
+            start = parse_datetime(request.GET["start"])
+        else:
+            start = datetime.datetime.now(tz=pytz.utc).replace(
+                day=1, hour=0, minute=0, second=0, microsecond=0
+            )
+        if "end" in request.GET:
+            end = parse_datetime(request.GET["end"])
+        else:
+            end = (start + datetime.timedelta(days=32)).replace(day=1)
+    except ValueError:
+        return None
+    if end <= start:
+        return None
+    return start, end
+
+
 def add_class(request, className):
     """
     Adds the class with class name className to the student whose id is associated with this request
@@ -341,12 +698,12 @@ def add_class(request, className):
         print("Cannot add a class to a student that does not exist")
         return
 
-    student = get_student(request)
-    class_set = student.classes
-    class_colors = student.class_colors
-    class_set.add(get_class(className))
-    class_colors[get_class(className)] = "#0052bd"
-    student.save()
+    clazz = get_class(className)
+    if clazz == None:
+        print("Cannot add a class that does not exist")
+        return
+    get_student(request).enroll(clazz)
+    vars(request).pop("class_color_map", None)
 
 
 def remove_class(request, className):
@@ -357,10 +714,8 @@ def remove_class(request, className):
         print("Cannot remove a class to a student that does not exist")
         return
 
-    student = get_student(request)
-    class_set = student.classes
-    class_set.remove(get_class(className))
-    student.save()
+    get_student(request).unenroll(get_class(className))
+    vars(request).pop("class_color_map", None)
 
 
 def is_professor(request):
@@ -446,97 +801,127 @@ def send_message(userId, text):
 
 def send_all_messages():
     """
-    Sends out all messages defined in Notification objects
+    Sends out all messages defined in Notification objects, and the ClassChanges of the classes of every student
+    All the messages pending for a recipient are coalesced into one email (see coalesce_messages)
+    ClassChanges made in the last settings.NOTIFICATION_COALESCE_WINDOW seconds wait for the next cycle, so changes
+    still being made (a syllabus upload) go out together. Messages queued while sending are left for the next cycle
+    Returns (and prints) the number of messages pending and of emails sent
     """
+    last_notification = models.Notification.objects.aggregate(last=Max("id"))["last"] or 0
+    notifs = models.Notification.objects.filter(id__lte=last_notification)
+    cutoff = datetime.datetime.now(tz=pytz.utc) - datetime.timedelta(
+        seconds=settings.NOTIFICATION_COALESCE_WINDOW
+    )
+    changes = list(models.ClassChange.objects.filter(created__lte=cutoff).order_by("id"))
 
-    notifs = models.Notification.objects.all()
-
-    print(f"Sending out {len(notifs)} emails...")
+    # recipient email -> the texts of their Notifications, and their name and ClassChanges
+    texts = {}
+    recipient_changes = {}
     for notif in notifs.iterator():
+        texts.setdefault(notif.email, []).append(notif.text)
+    class_changes = {}
+    for change in changes:
+        class_changes.setdefault(change.className, []).append(change)
+    for className, class_change_list in class_changes.items():
+        recipients = change_recipients(className)
+        for name, email in recipients.iterator(chunk_size=settings.NOTIFICATION_BATCH_SIZE):
+            recipient_changes.setdefault(email, (name, []))[1].extend(class_change_list)
+
+    messages = sum(len(notif_texts) for notif_texts in texts.values())
+    for email, (name, student_changes) in recipient_changes.items():
+        messages += len(student_changes)
+        texts.setdefault(email, []).append(change_message(name, student_changes))
+
+    print(f"Sending out {len(texts)} emails...")
+    for email, email_texts in texts.items():
         services.email_service.message(
-            text=notif.text, to=notif.email, subject="Assignment Organizer"
+            text=coalesce_messages(email_texts), to=email, subject="Assignment Organizer"
         )
 
-    models.Notification.objects.all().delete()
+    notifs.delete()
+    models.ClassChange.objects.filter(id__in=[change.id for change in changes]).delete()
 
-    print("Email sending successful!")
+    stats = {"messages": messages, "emails": len(texts)}
+    print("Email sending successful!", stats)
+    return stats
 
 
-def get_all_students(className):
+def coalesce_messages(texts):
     """
-    Returns a list of all students who have a class who's name is className
+    Returns the texts of the messages pending for a recipient, as the text of one email
     """
-    ret = []
+    return "<br><hr><br>".join(texts)
 
-    clazz = models.Class.objects.filter(className=className).first()
-    for student in models.Student.objects.all().iterator():
-        if clazz in student.classes:
-            ret.append(student)
 
-    return ret
+def get_all_students(className):
+    """
+    Returns a list of all students who have a class who's name is className
+    """
+    return list(
+        models.Student.objects.filter(enrollments__clazz__className=className).distinct().order_by("id")
+    )
 
 
 def notify_students_of_change(className, assignmentName, action):
     """
     Notifies all students of a className that an assignment has changed
+    The change is stored once, and is only expanded into an email per student when messages are sent
+    (see send_all_messages)
     """
-    print(get_all_students(className))
-    for student in get_all_students(className):
-        send_message(
-            student.userId,
-            f"""
-Dear {student.name},<br>
-<br>
-An assignment has been updated in one of your classes:<br>
+    models.ClassChange.objects.create(
+        className=className, assignmentName=assignmentName, action=action
+    )
+
+
+def change_message(name, changes):
+    """
+    Returns the email telling a student named name about changes (ClassChanges) to assignments of their classes
+    """
+    updates = "".join(
+        f"Assignment '{change.assignmentName}' was {change.action}d for class '{change.className}'.<br>"
+        for change in changes
+    )
+    heading = (
+        "An assignment has been updated in one of your classes:"
+        if len(changes) == 1
+        else f"{len(changes)} assignments have been updated in your classes:"
+    )
+    return f"""
+Dear {name},<br>
 <br>
-Assignment '{assignmentName}' was {action}d for class '{className}'.<br>
+{heading}<br>
 <br>
+{updates}<br>
 We hope you have a great day,<br>
 Assignment Organizer
-            """,
-        )
+            """
 
 
-def notify_students_of_today_assignments():
+def change_recipients(className):
     """
-    Notifies all students of assignments marked as due today
+    Returns the (name, email) of every student of className, in one query joining students to their users
+    Students without a user are left out
     """
-    now = datetime.datetime.now(tz=pytz.UTC)
+    emails = User.objects.filter(id=OuterRef("userId")).values("email")[:1]
+    return (
+        models.Student.objects.filter(enrollments__clazz__className=className)
+        .distinct()
+        .annotate(email=Subquery(emails))
+        .exclude(email=None)
+        .order_by("id")
+        .values_list("name", "email")
+    )
 
-    # this is to fix a weird date offset where dates are being reported as one day in advance
-    now = now - datetime.timedelta(days=1)
 
-    for student in models.Student.objects.all().iterator():
-        events = get_events_from_calendar_all_classes(
-            student, day=now.day, month=now.month, year=now.year
-        )
-        if len(events) != 0:
-            print("Sending daily assignment update")
-            events.sort(
-                key=lambda x: "None" if x["className"] == None else x["className"]
-            )
-            last_class = events[0]["className"]
-            last_class_str = "Personal" if last_class == None else last_class
-            event_string = f"For {last_class_str}:<br>"
-            for event in events:
-                if last_class != event["className"]:
-                    last_class = event["className"]
-                    last_class_str = "Personal" if last_class == None else last_class
-                    event_string += f"For {last_class_str}:<br>"
-                event_string += f"&emsp;{event['summary']}<br>"
-            send_message(
-                student.userId,
-                f"""
-Dear {student.name},<br>
-<br>
-You have some assignments due today:<br>
-<br>
-{event_string}<br>
-<br>
-Good luck on your classes,<br>
-Assignment Organizer
-            """,
-            )
+def notify_students_of_today_assignments(workers=None, shard=None, shards=None, strategy=None):
+    """
+    Notifies all students (of shard, out of shards) of assignments marked as due today
+    The students are split across workers processes, see digest.run
+    Returns (and prints) the number of students notified, calendars read, calendar api calls, failures and seconds taken
+    """
+    from . import digest
+
+    return digest.run(workers=workers, shard=shard, shards=shards, strategy=strategy)
 
 
 def get_argv():
@@ -550,28 +935,93 @@ def set_class_color(request, className, color):
     Sets the color of the class with class name to the user belonging to request with new color
     """
     student = get_student(request)
+    print("Saving color", color, "for class", className)
     if className == None:
         student.color = color
+        student.save()
+        student.colors_changed()
     else:
-        student.class_colors[get_class(className)] = color
-    print("Saving color", color, "for class", className)
-    student.save()
+        student.set_class_color(get_class(className), color)
+        vars(request).pop("class_color_map", None)
 
 
 def get_color(request, className=None):
     """
     Returns the class color for a class className (if provided) otherwise, default color
     """
-    return (
-        ("#0052bd" if not student_exists(request) else get_student(request).color)
-        if className == None or not class_exists_for_student(request, className)
-        else get_student(request).class_colors[get_class(className)]
-    )
+    default = "#0052bd" if not student_exists(request) else get_student(request).color
+    if className == None:
+        return default
+    return class_color_map(request).get(str(className), default)
+
+
+def class_color(request, clazz):
+    """
+    Returns the color the student of this request picked for clazz (a Class, or None)
+    Falls back to the student's own color if they do not take clazz, or the default color for the null user
+    """
+    return get_color(request, None if clazz == None else clazz.className)
+
+
+def class_color_map(request):
+    """
+    Returns a dictionary from the name of every class the student of this request takes to its color
+    Built once per request, and shared by everything that renders on it (kept in request.class_color_map)
+    """
+    if "class_color_map" not in vars(request):
+        request.class_color_map = (
+            {}
+            if not student_exists(request)
+            else {
+                clazz.className: color
+                for clazz, color in get_student(request).class_colors.items()
+            }
+        )
+    return request.class_color_map
 
 
 def className_from_url(request):
     """
     Attempts to parse a string classname from a request url
+    Returns None if there is no class in the url, or if the class does not exist
+    """
+    clazz = current_class(request)
+    if clazz == None:
+        return None
+    return clazz.className
+
+
+def current_class(request):
+    """
+    Returns the Class whose page is being requested, or None
+    Resolved once per request, and kept in request.current_class (see middleware.CurrentClassMiddleware)
+    """
+    if "current_class" not in vars(request):
+        request.current_class = load_current_class(request)
+    return request.current_class
+
+
+def load_current_class(request):
+    """
+    Loads the Class named by the className of the url this request was routed with
+    Routes without a className return None without touching the database
+    """
+    resolver_match = vars(request).get("resolver_match")
+    if resolver_match != None:
+        kwargs = resolver_match.kwargs
+        # in classes/<untrueClassName>/view/<className>/... the page belongs to untrueClassName
+        className = kwargs.get("untrueClassName", kwargs.get("className"))
+    else:
+        # requests that did not go through the url resolver
+        className = className_in_url(request)
+    if className == None:
+        return None
+    return get_class(className)
+
+
+def className_in_url(request):
+    """
+    Parses the string classname out of a request url, without checking that the class exists
     """
     url = str(request.get_full_path()).replace("%20", " ")
     if "classes" not in url:
@@ -581,26 +1031,28 @@ def className_from_url(request):
         url = url[: url.index("/")]
     except:
         return None
-    if not class_exists(url):
-        return None
     return url
 
 
-def num_days_until(date_string):
+def num_days_until(date, now=None):
     """
-    Returns the number of days until date_string
+    Returns the number of days until date (a datetime, or an isoformat string)
+    now is the time to count from, default the current time. Dates without a timezone are in UTC
     """
-    then = datetime.datetime.fromisoformat(date_string).replace(tzinfo=None)
-    now = datetime.datetime.now().replace(tzinfo=None)
-    diff = then - now
-    return diff.days
+    if isinstance(date, str):
+        date = parse_datetime(date)
+    elif date.tzinfo == None:
+        date = pytz.utc.localize(date)
+    if now == None:
+        now = datetime.datetime.now(tz=pytz.utc)
+    return (date - now).days
 
 
-def days_until_string(date_string):
+def days_until_string(date, now=None):
     """
     Returns a string form of num_days_until
     """
-    diff = num_days_until(date_string)
+    diff = num_days_until(date, now)
 
     if diff == 0:
         return "Due Today"
@@ -614,17 +1066,39 @@ def days_until_string(date_string):
         return f"Due in {diff} Days"
 
 
+def request_now(request):
+    """
+    Returns the current time, as seen by this request. It is taken once per request and kept in request.now,
+    so every due date of a page is counted from the same time
+    """
+    if request == None:
+        return datetime.datetime.now(tz=pytz.utc)
+    if "now" not in vars(request):
+        request.now = datetime.datetime.now(tz=pytz.utc)
+    return request.now
+
+
 def is_checked_off(request, event):
     """
     Determines if a student checked off this assignment, signifying they have completed it
+    event is an Event, or an event dictionary from the calendar api
     """
-    student_id = get_student(request).userId
-    return (
-        models.CheckedAssignments.objects.filter(
-            userId=student_id, className=str(event['className']), eventId=event['id']
-        ).count()
-        != 0
-    )
+    event = as_event(event)
+    return (str(event.className), str(event.id)) in checked_assignments(request)
+
+
+def checked_assignments(request):
+    """
+    Returns the set of (className, eventId) pairs the student of this request checked off
+    Loaded in a single query the first time a request renders a checkmark, then kept in request.checked_assignments
+    """
+    if "checked_assignments" not in vars(request):
+        request.checked_assignments = set(
+            models.CheckedAssignments.objects.filter(
+                userId=get_student(request).userId
+            ).values_list("className", "eventId")
+        )
+    return request.checked_assignments
 
 
 def todo_list(request, className=None, editable=False, todo_loc=False):
@@ -634,104 +1108,206 @@ def todo_list(request, className=None, editable=False, todo_loc=False):
     if corresponding event is authenticated professor for user, deletable
     otherwise, checkable
     todo_loc is used to modify the URL to work for todo list edits
+    The html is cached per student until their events, checkmarks or colors change (see todo_cache_key)
     """
     if not student_exists(request):
         return None
-    events = sorted(
-        get_all_events(request, className),
-        key=lambda event: datetime.datetime.fromisoformat(event["end"]["dateTime"]),
-    )
+    key = todo_cache_key(request, className, editable, todo_loc)
+    if key != None:
+        cached = todo_cache().get(key)
+        if cached != None and cached[0] > time.time():
+            return cached[1]
+
+    events = Timeline(get_all_events(request, className), now=request_now(request))
+
+    ret = get_template("mainapp/todo_fragment.html").render(
+        {
+            "missing": mark_safe(missing_calendars_html(request)),
+            "future": assignment_rows(request, events.future(), className, editable),
+            "past": assignment_rows(request, events.past(), className, editable),
+            "editable": editable,
+        }
+    ).strip()
+
+    # a calendar that failed to load is missing from the html, so it is not cached
+    if key != None and len(unavailable_calendars(request)) == 0:
+        # due dates change with time, so the html expires when the first of them changes
+        expires = min(settings.TODO_CACHE_TTL, events.next_change())
+        todo_cache().set(key, (time.time() + expires, ret), timeout=int(expires) + 1)
+    return ret
 
-    past_events = [
-        event for event in events if num_days_until(event["end"]["dateTime"]) < 0
-    ]
-    future_events = [
-        event for event in events if num_days_until(event["end"]["dateTime"]) >= 0
+
+def todo_cache():
+    """
+    Returns the django cache holding rendered todo lists
+    """
+    return caches[settings.TODO_CACHE_ALIAS]
+
+
+def calendar_versions(request, className=None):
+    """
+    Returns the (calendarId, version) pairs of the mirror of every calendar read by get_all_events,
+    after bringing them up to date, or None if they have no versions (see event_mirror) or one failed to sync
+    Anything rendered from these calendars can be cached under these versions
+    """
+    if not settings.EVENT_MIRROR_ENABLED:
+        return None
+    calendarIds = [calendarId for calendarId, _ in todo_calendars(request, className)]
+    if len(refresh_request_calendars(request, calendarIds)) != 0:
+        return None
+    return [
+        (str(calendarId), request.calendar_versions[str(calendarId)]) for calendarId in calendarIds
     ]
 
-    ret = assignment_html(request, future_events, className, editable, todo_loc)
-    if len(past_events):
-        ret += '<h5 style="text-align:center; width:100%;">Past-Due Assignments:</h5>'
-        ret += assignment_html(request, past_events, className, editable, todo_loc)
-    return ret
+
+def todo_cache_key(request, className=None, editable=False, todo_loc=False):
+    """
+    Returns the cache key of the todo list of the student of this request, or None if it cannot be cached
+    The key changes whenever anything the list shows changes: the sync version of every calendar it reads
+    (see event_mirror), the student's checked_version (checkmarks) and color_version (classes and colors)
+    Due dates change with time instead, so entries expire when the first due date changes (see Timeline.next_change)
+    """
+    if settings.TODO_CACHE_TTL <= 0:
+        return None
+    versions = calendar_versions(request, className)
+    if versions == None:
+        return None
+    student = get_student(request)
+    parts = repr(
+        (
+            className,
+            editable,
+            todo_loc,
+            student.professor,
+            versions,
+            student.checked_version,
+            student.color_version,
+        )
+    )
+    return f"todo:{student.userId}:{hashlib.sha1(parts.encode()).hexdigest()}"
 
 
 def assignment_html(request, events, className=None, editable=False, todo_loc=False):
     """
-    Given events list, displays html assignment format
+    Given a list of Events, displays html assignment format
+    Colors come from the stylesheet of the student (see student_css), the markup only names the class
     """
-    ret = ""
-    for i, event in enumerate(events):
-
-        ret += f"""<div class="container">
-        <div class="container" style="{"" if not is_checked_off(request, event) else "text-decoration: line-through;"} border-radius:1.5vh; background-color:{get_color(request, event['description'])};
-        font-size:1.2vw; color:{"white" if not is_checked_off(request, event) else "gray"}; padding-left:5%; margin-bottom: 10px;">
-        <div class="item" style="width:30%;overflow-wrap: break-word;">{event['summary']}</div>"""
-        if className == None:
-            ret += f"""
-            <div style="text-align:center;overflow-wrap: break-word;" class="item">{event['description'] if str(event['description']) != "None" else "Personal"}</div>"""
-        ret += f"""
-        <div class="item" style="padding-right:5%;width:30%;text-align:right;overflow-wrap: break-word;">{days_until_string(event['end']['dateTime'])}</div>
-        """
-        ret += "</div>"
+    return get_template("mainapp/assignments.html").render(
+        {
+            "assignments": assignment_rows(request, events, className, editable),
+            "editable": editable,
+        }
+    )
 
-        if editable:
 
-            ret += f"""<a href="{event['className']}/{event['id']}/delete_assignment/check/">
-            """
+def assignment_rows(request, events, className=None, editable=False):
+    """
+    Returns what mainapp/assignments.html shows for each of events
+    """
+    return [
+        {
+            "checked": is_checked_off(request, event),
+            "css_classes": class_css_classes(event.description),
+            "summary": event.summary,
+            "class_label": None
+            if className != None
+            else (event.description if str(event.description) != "None" else "Personal"),
+            "due": days_until_string(event.end, request_now(request)),
+            "url": f"{event.className}/{event.id}/delete_assignment/",
+            "deletable": editable and is_admin_of_event(request, event),
+        }
+        for event in events
+    ]
 
-            ret += f"""<button style="right:-20%; border-radius:80px;color:white;
-            background-color:green; border:none;width:20%;font-size:1.2vw;position:absolute;"><i class='bx bx-{'check-' if is_checked_off(request, event) else ''}square'></i> Check Off</button></a>"""
 
-        if editable and (is_admin_of_event(request, event)):
-            ret += f"""<a href="{event['className']}/{event['id']}/delete_assignment/delete/">
-            """
-            ret += f"""<button style="left:-20%; border-radius:80px;color:white;
-            background-color:red; border:none;width:20%;font-size:1.2vw;position:absolute;"><i class='bx bx-trash'></i>    Delete</button></a>"""
-        ret += "</div>"
-    return ret
+def class_css_classes(className=None):
+    """
+    Returns the css classes that color an assignment of className (see student_css)
+    class-default colors it with the student's own color, unless the stylesheet has a rule for className
+    """
+    if str(className) == "None":
+        return "class-default"
+    return f"class-default {class_css_name(className)}"
+
+
+def class_css_name(className):
+    """
+    Returns the css class name used for the color of className. Class names can hold any character,
+    so they are hashed into a valid css identifier
+    """
+    return "class-" + hashlib.sha1(str(className).encode()).hexdigest()[:10]
+
+
+def student_css(request):
+    """
+    Returns the stylesheet holding the student's own color, and a rule with the color of each of their classes
+    """
+    rules = [f".class-default {{ background-color: {css_color(get_color(request))}; }}"]
+    if student_exists(request):
+        for clazz, color in sorted(
+            get_student(request).class_colors.items(), key=lambda item: item[0].className
+        ):
+            rules.append(
+                f".{class_css_name(clazz.className)} {{ background-color: {css_color(color)}; }}"
+            )
+    return "\n".join(rules) + "\n"
+
+
+def css_color(color):
+    """
+    Returns color if it is a hex color, so nothing else can end up in a stylesheet, otherwise the default color
+    """
+    if re.fullmatch("#[0-9a-fA-F]{3,8}", str(color)) == None:
+        return models.DEFAULT_CLASS_COLOR
+    return color
+
+
+def student_css_url(request):
+    """
+    Returns the url of the stylesheet of the student of this request, which changes whenever their colors change
+    """
+    if not student_exists(request):
+        return reverse("student_css", kwargs={"user_id": 0, "version": 0})
+    student = get_student(request)
+    return reverse(
+        "student_css", kwargs={"user_id": student.userId, "version": student.color_version}
+    )
 
 
 def check_off(request, event_id, className):
     """
     Checks off assignment with event id and classname for the student
     """
-    student_id = get_student(request).userId
-    if is_checked_off(request, {"id" : event_id, 'className': className}):
+    student = get_student(request)
+    student_id = student.userId
+    checked = checked_assignments(request)
+    student.checkmarks_changed()
+    if is_checked_off(request, Event(id=event_id, className=className)):
         print("Assignment for class", className, "is already checked off")
         models.CheckedAssignments.objects.filter(
             userId=student_id, className=className, eventId=event_id
         ).delete()
+        checked.discard((str(className), str(event_id)))
         return
     print("Checking off", className, "assignment with type", type(className))
     models.CheckedAssignments.objects.create(
         userId=student_id, className=className, eventId=event_id
     )
+    checked.add((str(className), str(event_id)))
 
 
 def list_members_of_class(className):
     """
     Returns a list of every member of a class
     """
-    if not class_exists(className):
-        return []
-
-    clazz = get_class(className)
-    all_students = models.Student.objects.all()
-    ret = []
-
-    for student in all_students.iterator():
-        if clazz in student.classes:
-            ret.append(student)
-
-    return ret
+    return list(
+        models.Student.objects.filter(enrollments__clazz__className=className).distinct().order_by("id")
+    )
 
 def get_user_with_id(userId):
     """
-    Returns a student object given their unique id
+    Returns a student object given their unique id, or None if there is no such student
     """
-    if not user_with_id_exists(userId):
-        return None
     return models.Student.objects.filter(userId=userId).first()
 
 def user_with_id_exists(userId):
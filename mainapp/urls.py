@@ -66,11 +66,19 @@ urlpatterns = [
     path("change_color/<str:className>/", views.change_color, name="change_color"),
     path("change_color/", views.change_color, name="change_color"),
     path("todo/", views.todo_list, name="todo"),
+    path("todo/agenda_items/", views.agenda_items, name="agenda_items"),
     path("save_username/", views.change_profile_photo, name="change_profile_photo"),
 
     path('user/<int:user_id>/', views.user_page, name="user"),
     path('user/', views.user_page, name="user"),
     path('user/edit/', views.edit_profile, name="edit_profile"),
+    path("cache_stats/", views.cache_stats, name="cache_stats"),
+    path("api/events/", views.events_api, name="events_api"),
+    path(
+        "styles/<int:user_id>/<int:version>/student.css",
+        views.student_css,
+        name="student_css",
+    ),
 ]
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -3,9 +3,11 @@ import logging
 from django.core.exceptions import ValidationError
 from django.forms.widgets import SelectDateWidget
 from django.shortcuts import render
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.template.response import TemplateResponse
+from django.views.decorators.http import condition, require_GET
 from . import tools, models, forms
+from .event_cache import cache as event_cache
 from .calendar_generator import Calendar
 from django.utils.safestring import mark_safe
 from django.urls import reverse
@@ -13,6 +15,8 @@ import datetime as dt
 from datetime import datetime
 import django
 import csv
+import hashlib
+import os
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
 from .forms import FileForm
@@ -541,6 +545,15 @@ def todo_list(request):
     if not tools.student_exists(request):
         return render(request, "mainapp/index.html", {"ERR_NOT_LOGGED_IN": True})
 
+    # the agenda only renders the next few assignments, and loads the rest when asked (see agenda_items)
+    if request.GET.get("mode") == "agenda":
+        agenda = tools.agenda_html(request)
+        return render(
+            request,
+            "mainapp/agenda.html",
+            {"agenda": mark_safe(tools.missing_calendars_html(request) + agenda)},
+        )
+
     todo = tools.todo_list(request, editable=True, todo_loc=True)
     return render(
         request,
@@ -548,6 +561,21 @@ def todo_list(request):
         {"todo": mark_safe(todo), "has_todo": len(todo) != 0,},
     )
 
+
+def agenda_items(request):
+    """
+    A page of the agenda after the cursor parameter, as html for the agenda page to add to its list
+    The past parameter asks for past-due assignments instead of upcoming ones
+    """
+    if not tools.student_exists(request):
+        return HttpResponse(status=403)
+    cursor = None
+    if "cursor" in request.GET:
+        cursor = tools.decode_cursor(request.GET["cursor"])
+        if cursor == None:
+            return HttpResponse(status=400)
+    return HttpResponse(tools.agenda_html(request, past="past" in request.GET, cursor=cursor))
+
 def change_profile_photo(request):
     """
     Changes profile for current user
@@ -567,17 +595,18 @@ def user_page(request, user_id=None):
     if user_id == None:
         user_id = tools.get_student(request).userId
 
+    student = tools.get_user_with_id(user_id)
     # bad url query
-    if not tools.user_with_id_exists(user_id):
+    if student == None:
         return render(request, "mainapp/index.html")
 
     return render(
             request,
             "mainapp/user.html",
             {
-            'student': tools.get_user_with_id(user_id),
-            'description': mark_safe(tools.get_user_with_id(user_id).description),
-            'mood': mark_safe(tools.get_user_with_id(user_id).mood),
+            'student': student,
+            'description': mark_safe(student.description),
+            'mood': mark_safe(student.mood),
             'owner' : tools.get_student(request).userId == user_id,
             }
         )
@@ -677,4 +706,67 @@ def edit_profile(request):
     return render(
         request, "mainapp/edit_user.html", {"form": form}
     )
-    
\ No newline at end of file
+    
+
+
+def cache_stats(request):
+    """
+    Shows the hit rate and size of the shared event cache, for staff only
+    The counters and the process-wide tier belong to the process serving the request, which is reported as process
+    """
+    if not request.user.is_staff:
+        return redirect("index")
+    return JsonResponse(dict(event_cache.stats(), process=os.getpid()))
+
+
+def events_etag(request):
+    """
+    ETag of the events api: it changes whenever the events of the student, or their checkmarks, change
+    None (no ETag) if the events cannot be versioned, for example when a calendar failed to load
+    """
+    date_range = tools.get_date_range(request)
+    if date_range == None or not tools.student_exists(request):
+        return None
+    versions = tools.calendar_versions(request)
+    if versions == None:
+        return None
+    parts = repr((date_range, versions, tools.get_student(request).checked_version))
+    return hashlib.sha1(parts.encode()).hexdigest()
+
+
+@require_GET
+@condition(etag_func=events_etag)
+def events_api(request):
+    """
+    The events of the current student ending between the start and end parameters, as json
+    Replies 304 Not Modified if they did not change since the ETag sent in If-None-Match
+    """
+    if not tools.student_exists(request):
+        return JsonResponse({"error": "Not logged in"}, status=403)
+    date_range = tools.get_date_range(request)
+    if date_range == None:
+        return JsonResponse({"error": "start and end must be dates, with end after start"}, status=400)
+
+    start, end = date_range
+    events = tools.get_events_between(request, start, end)
+    return JsonResponse(
+        {
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "events": [tools.event_json(request, event) for event in events],
+            "unavailable": sorted(set(tools.unavailable_calendars(request))),
+        }
+    )
+
+
+def student_css(request, user_id, version):
+    """
+    Stylesheet with the colors of the current student. Its url changes with their colors,
+    so browsers can keep it until then
+    """
+    url = tools.student_css_url(request)
+    if request.path != url:
+        return redirect(url)
+    response = HttpResponse(tools.student_css(request), content_type="text/css")
+    response["Cache-Control"] = "private, max-age=31536000, immutable"
+    return response